@@ -0,0 +1,60 @@
+"""Compare FastGenericDualOptimizer(index='approximate') with the exhaustive search.
+
+Usage: python benchmark_index.py [charmask or templates.npy] [probes,...]
+
+A .npy file is read as an (N, 16, 16) array of glyph templates instead of the bundled ones.
+For each number of probes, prints the time of best_chars on the blocks of the example images,
+the fraction of blocks getting the same char as with the exhaustive search
+and the increase of the total squared error of the rendering.
+"""
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from img2unicode import FastGenericDualOptimizer, Renderer
+from img2unicode.templates import Templates
+from img2unicode.utils import cubify
+
+this = Path(__file__).parent
+images = ['obama.jpg', 'matplotlib.png']
+source = sys.argv[1] if len(sys.argv) > 1 else 'all'
+probes = [int(p) for p in sys.argv[2].split(',')] if len(sys.argv) > 2 else [1, 2, 4, 8, 16]
+if source.endswith('.npy'):
+    kwargs = dict(charmask=None, templates=Templates(np.load(source)))
+else:
+    kwargs = dict(charmask=source)
+
+renderer = Renderer(max_w=160, max_h=60, dtype='float32')
+Q = np.concatenate([cubify(renderer._prepare_image(renderer._ensure_image(this/img)), (16, 8, 3))
+                    for img in images]).reshape(-1, 16*8, 3)
+
+
+def errors(optimizer, chars):
+    """Squared error of rendering each block with its char and the mean colors, see `best_chars`."""
+    rows = Q.transpose(0, 2, 1)
+    scores = (np.square(np.einsum('bcp,bp->bc', rows, optimizer.cs1[chars]))
+              + np.square(np.einsum('bcp,bp->bc', rows, optimizer.cs2[chars]))).sum(axis=1)
+    return np.square(Q).sum(axis=(1, 2)) - scores
+
+
+def timed(optimizer):
+    s = time.time()
+    chars = optimizer.best_chars(Q)
+    return chars, time.time() - s
+
+
+exhaustive = FastGenericDualOptimizer(dtype='float32', **kwargs)
+reference, reference_time = timed(exhaustive)
+reference_error = errors(exhaustive, reference).sum()
+print(f"{len(Q)} blocks, {exhaustive.n_chars} templates, exhaustive search {reference_time:.2f}s")
+print("""
+| Probes | Time | Speed-up | Same char | Error increase |
+| ------ | ---- | -------- | --------- | -------------- |
+""", end='')
+for p in probes:
+    optimizer = FastGenericDualOptimizer(dtype='float32', index='approximate', probes=p, **kwargs)
+    chars, elapsed = timed(optimizer)
+    increase = errors(optimizer, chars).sum() / reference_error - 1
+    print(f"| {p} | {elapsed:.2f}s | {reference_time/elapsed:.1f}x | {(chars == reference).mean():.1%} | {increase:.2%} |")
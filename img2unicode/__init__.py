@@ -1,3 +1,7 @@
+from .ann import *
+from .ansi import *
 from .dual import *
 from .gamma import *
 from .renderer import *
+from .temporal import *
+from .memo import *
@@ -0,0 +1,255 @@
+"""Nearest neighbour backends used by the gamma optimizers.
+
+A backend builds an index of a dataset (rows of templates), saves and loads it,
+and searches it with a batch of queries, returning the indices of the nearest rows
+and their squared euclidean distances.
+New backends are added with `register_backend`.
+"""
+import os
+import pickle
+
+import numpy as np
+import sklearn
+from sklearn.neighbors import NearestNeighbors
+
+BACKENDS = {}
+
+
+def register_backend(name):
+    def register(cls):
+        cls.name = name
+        BACKENDS[name] = cls
+        return cls
+    return register
+
+
+def get_backend(name, **params):
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown nearest neighbour backend %s, choose one of: %s" % (name, ', '.join(BACKENDS)))
+    return backend(**params)
+
+
+def available_backends():
+    """Names of the backends whose dependencies are installed."""
+    return [name for name, backend in BACKENDS.items() if backend.available()]
+
+
+class Backend:
+    name = None
+    # Whether search always finds the nearest row
+    exact = True
+
+    @staticmethod
+    def available():
+        return True
+
+    def params(self):
+        """Parameters of the built index, part of its cache key."""
+        return {}
+
+    def build(self, dataset):
+        raise NotImplementedError
+
+    def save(self, index, path):
+        with open(path, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, path, dataset):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def search(self, index, queries, n_jobs=-1):
+        """Nearest rows of the index for queries (B, d): (indices (B,), squared distances (B,))."""
+        indices, distances = self.search_knn(index, queries, 1, n_jobs)
+        return indices[:, 0], distances[:, 0]
+
+    def search_knn(self, index, queries, k, n_jobs=-1):
+        """k nearest rows of the index for queries (B, d), nearest first: (indices (B, k), squared distances (B, k))."""
+        raise NotImplementedError
+
+
+def _top_k(distances, ids, k):
+    """k smallest distances in each row, ordered by distance and then by id, so that ties go to the lower id."""
+    if k < distances.shape[1]:
+        part = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        distances = np.take_along_axis(distances, part, axis=1)
+        ids = np.take_along_axis(ids, part, axis=1)
+    order = np.lexsort((ids, distances))
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+
+@register_backend('brute')
+class BruteBackend(Backend):
+    """Exact search computing all distances with matrix products, in batches of `batch_elements` distances.
+
+    |q|^2 - 2 q.d + |d|^2 cancels, so it is computed in float64.
+    """
+    def __init__(self, batch_elements=2**22):
+        self.batch_elements = batch_elements
+
+    def build(self, dataset):
+        dataset = np.ascontiguousarray(dataset, dtype='float64')
+        return dataset, (dataset**2).sum(axis=1)
+
+    def search_knn(self, index, queries, k, n_jobs=-1):
+        dataset, norms = index
+        k = min(k, len(dataset))
+        indices = np.empty((len(queries), k), dtype='int')
+        distances = np.empty((len(queries), k))
+        ids = np.arange(len(dataset))
+        step = max(1, self.batch_elements // max(1, len(dataset)))
+        for start in range(0, len(queries), step):
+            q = np.asarray(queries[start:start+step], dtype='float64')
+            d = norms - 2 * (q @ dataset.T)
+            if k == 1:
+                best = d.argmin(axis=1)[:, np.newaxis]
+                nearest = np.take_along_axis(d, best, axis=1)
+            else:
+                best, nearest = _top_k(d, np.broadcast_to(ids, d.shape), k)
+            indices[start:start+step] = best
+            distances[start:start+step] = np.maximum(nearest + (q**2).sum(axis=1)[:, np.newaxis], 0)
+        return indices, distances
+
+
+@register_backend('ivf')
+class IVFBackend(Backend):
+    """Approximate inverted file index in pure NumPy.
+
+    The rows are clustered into `n_lists` lists by k-means, and each query is compared
+    with the rows of its `n_probes` nearest lists only. The queries probing a list are
+    compared with it at once, with a matrix product.
+    n_lists defaults to 4*sqrt(N).
+    """
+    exact = False
+
+    def __init__(self, n_lists=None, n_probes=8, iterations=10, seed=0):
+        self.n_lists = n_lists
+        self.n_probes = n_probes
+        self.iterations = iterations
+        self.seed = seed
+
+    def params(self):
+        return dict(n_lists=self.n_lists, iterations=self.iterations, seed=self.seed)
+
+    def build(self, dataset):
+        dataset = np.asarray(dataset)
+        n_lists = min(len(dataset), self.n_lists or max(1, int(4 * np.sqrt(len(dataset)))))
+        rng = np.random.default_rng(self.seed)
+        centroids = dataset[rng.choice(len(dataset), n_lists, replace=False)].astype('float64')
+        norms = (dataset.astype('float64')**2).sum(axis=1)
+        for _ in range(self.iterations):
+            labels = (norms[:, np.newaxis] - 2 * dataset @ centroids.T + (centroids**2).sum(axis=1)).argmin(axis=1)
+            counts = np.bincount(labels, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, dataset)
+            # Empty lists keep their centroid
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+        labels = (norms[:, np.newaxis] - 2 * dataset @ centroids.T + (centroids**2).sum(axis=1)).argmin(axis=1)
+
+        # Rows of each list are stored contiguously, in their original order
+        order = np.argsort(labels, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))])
+        return dict(centroids=centroids.astype(dataset.dtype), rows=np.ascontiguousarray(dataset[order]),
+                    norms=norms[order], ids=order, offsets=offsets)
+
+    def search_knn(self, index, queries, k, n_jobs=-1):
+        centroids, rows, norms, ids, offsets = (index[key] for key in ('centroids', 'rows', 'norms', 'ids', 'offsets'))
+        n_probes = min(self.n_probes, len(centroids))
+        q_norms = (queries**2).sum(axis=1)
+        to_centroids = (centroids**2).sum(axis=1) - 2 * (queries @ centroids.T)
+        probes = np.argpartition(to_centroids, n_probes - 1, axis=1)[:, :n_probes]
+
+        k = min(k, len(rows))
+        best = np.zeros((len(queries), k), dtype='int')
+        best_distance = np.full((len(queries), k), np.inf)
+        # Group the (query, list) pairs by list
+        pairs = np.argsort(probes, axis=None, kind='stable')
+        lists = probes.ravel()[pairs]
+        starts = np.searchsorted(lists, np.arange(len(centroids) + 1))
+        for l in range(len(centroids)):
+            if starts[l] == starts[l+1] or offsets[l] == offsets[l+1]:
+                continue
+            selected = pairs[starts[l]:starts[l+1]] // n_probes
+            d = norms[offsets[l]:offsets[l+1]] - 2 * (queries[selected] @ rows[offsets[l]:offsets[l+1]].T)
+            # Merge with the best rows found so far, ties go to the lower row index as in an exact search
+            best[selected], best_distance[selected] = _top_k(
+                np.concatenate([best_distance[selected], d], axis=1),
+                np.concatenate([best[selected], np.broadcast_to(ids[offsets[l]:offsets[l+1]], d.shape)], axis=1), k)
+        return best, np.maximum(best_distance + q_norms[:, np.newaxis], 0)
+
+
+@register_backend('sklearn')
+class SklearnBackend(Backend):
+    """Exact search with scikit-learn's KD-tree."""
+    def __init__(self, leaf_size=10):
+        self.leaf_size = leaf_size
+
+    def params(self):
+        return dict(algorithm='kd_tree', leaf_size=self.leaf_size, sklearn=sklearn.__version__)
+
+    def build(self, dataset):
+        return NearestNeighbors(n_neighbors=1, algorithm='kd_tree', n_jobs=1, leaf_size=self.leaf_size).fit(dataset)
+
+    def search_knn(self, index, queries, k, n_jobs=-1):
+        index.n_jobs = n_jobs
+        distances, indices = index.kneighbors(queries, n_neighbors=min(k, index.n_samples_fit_))
+        return indices, distances**2
+
+
+@register_backend('n2')
+class N2Backend(Backend):
+    """Approximate search with the HNSW graph of the optional n2 package."""
+    exact = False
+
+    def __init__(self, m=5):
+        self.m = m
+
+    @staticmethod
+    def available():
+        try:
+            _import_hnsw()
+        except ImportError:
+            return False
+        return True
+
+    def params(self):
+        return dict(algorithm='hnsw', m=self.m)
+
+    def build(self, dataset):
+        index = _import_hnsw()(dataset.shape[1], "euclidean")
+        for i in dataset:
+            index.add_data(i)
+        index.build(m=self.m)
+        return index
+
+    def save(self, index, path):
+        index.save(path)
+
+    def load(self, path, dataset):
+        index = _import_hnsw()(dataset.shape[1], "euclidean")
+        index.load(path)
+        return index
+
+    def search_knn(self, index, queries, k, n_jobs=-1):
+        num_threads = n_jobs if n_jobs > 0 else os.cpu_count() or 1
+        res = index.batch_search_by_vectors(queries, k, num_threads=num_threads, include_distances=True)
+        # The graph search may find fewer than k rows, repeat the farthest one then
+        res = [r + r[-1:] * (k - len(r)) for r in res]
+        # n2 gives squared distances already
+        return (np.array([[i for i, _ in r] for r in res], dtype='int'),
+                np.array([[d for _, d in r] for r in res]))
+
+
+def _import_hnsw():
+    try:
+        from n2 import HnswIndex
+    except ModuleNotFoundError:
+        raise ImportError(
+            "n2 is not installed."
+            " To install it as an optional dependency,"
+            " run `pip install 'img2unicode[n2]'`"
+        )
+    return HnswIndex
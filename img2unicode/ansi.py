@@ -0,0 +1,344 @@
+"""Bulk encoding of rendered (chars, fgs, bgs) arrays into ANSI terminal output."""
+import collections
+import functools
+import io
+
+import numpy as np
+
+DEFAULT_SENTINEL = '\N{LEFT-TO-RIGHT OVERRIDE}' # '\u202D'
+
+RESET = '\x1b[0m'
+
+
+def _escape_tables(code):
+    """Escape pieces for every byte value of the r, g and b channels.
+
+    Concatenating ``r[x] + g[y] + b[z]`` gives exactly ``"\\x1b[{code};2;{x};{y};{z}m"``.
+    """
+    digits = [str(i) for i in range(256)]
+    r = np.array(['\x1b[%d;2;%s;' % (code, d) for d in digits], dtype=object)
+    g = np.array([d + ';' for d in digits], dtype=object)
+    b = np.array([d + 'm' for d in digits], dtype=object)
+    return r, g, b
+
+
+FORE_TABLES = _escape_tables(38)
+BACK_TABLES = _escape_tables(48)
+
+
+def _lookup(tables, colors):
+    r, g, b = tables
+    colors = np.asarray(colors, dtype='uint8')
+    return r[colors[..., 0]] + g[colors[..., 1]] + b[colors[..., 2]]
+
+
+# Colors of the 16 system colors, as in xterm
+XTERM_16 = np.array([
+    (0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0),
+    (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+    (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0),
+    (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255),
+], dtype='uint8')
+
+
+def xterm_256():
+    """Colors of the xterm 256-color palette: 16 system colors, 6x6x6 cube and 24 grays."""
+    levels = np.array([0, 95, 135, 175, 215, 255])
+    cube = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)
+    grays = np.repeat(np.arange(8, 248, 10)[:, np.newaxis], 3, axis=1)
+    return np.concatenate([XTERM_16, cube, grays]).astype('uint8')
+
+
+Palette = collections.namedtuple('Palette', ['rgb', 'lut', 'fore', 'back'])
+
+LUT_BITS = 5
+
+
+@functools.lru_cache(maxsize=None)
+def get_palette(name):
+    """Get a palette with its RGB->palette lookup table and escape tables.
+
+    name - '256' for the color cube and grayscale ramp of the 256-color mode
+           (system colors are skipped, as they depend on the terminal theme),
+           '16' for the basic 8 + 8 bright colors.
+
+    `lut` maps colors quantized to 5 bits per channel to palette entries,
+    `fore` and `back` map palette entries to their escapes.
+    """
+    if name == '256':
+        rgb = xterm_256()[16:]
+        codes = np.arange(16, 256)
+        fore = np.array(['\x1b[38;5;%dm' % c for c in codes], dtype=object)
+        back = np.array(['\x1b[48;5;%dm' % c for c in codes], dtype=object)
+    elif name == '16':
+        rgb = XTERM_16
+        fore = np.array(['\x1b[%dm' % (30 + c if c < 8 else 90 + c - 8) for c in range(16)], dtype=object)
+        back = np.array(['\x1b[%dm' % (40 + c if c < 8 else 100 + c - 8) for c in range(16)], dtype=object)
+    else:
+        raise ValueError("Unknown palette %s" % name)
+
+    # Centers of the quantization cells
+    steps = np.arange(0, 256, 256 >> LUT_BITS) + (128 >> LUT_BITS)
+    if name == '256':
+        lut = _cube_and_grays_lut(steps)
+    else:
+        grid = np.stack(np.meshgrid(steps, steps, steps, indexing='ij'), axis=-1).reshape(-1, 3)
+        lut = np.argmin(_weighted_distances(grid, rgb), axis=1).astype('uint8')
+    return Palette(rgb, lut, fore, back)
+
+
+# Cheap perceptual weighting of the channels
+WEIGHTS = np.array([2, 4, 3])
+
+
+def _weighted_distances(colors, rgb):
+    """Weighted squared distances (n, k) of colors (n, 3) to palette colors (k, 3), without (n, k, 3) temporaries."""
+    colors, rgb = colors.astype('int64'), rgb.astype('int64')
+    return (((colors ** 2) @ WEIGHTS)[:, np.newaxis] - 2 * (colors * WEIGHTS) @ rgb.T
+            + ((rgb ** 2) @ WEIGHTS)[np.newaxis])
+
+
+def _cube_and_grays_lut(steps):
+    """Lookup table of the 256-color palette without the system colors, i.e. entries 16-255 counted from 0.
+
+    The distance to the 6x6x6 cube is separable, so its nearest entry is found per channel,
+    and only the 24 grays are compared with the whole colors. Ties go to the lower entry.
+    """
+    levels = xterm_256()[16:16 + 216:36, 0].astype('int64')
+    to_levels = (steps[:, np.newaxis] - levels) ** 2
+    nearest = to_levels.argmin(axis=1)
+    # Per channel distance to the nearest level, weighted
+    channel = to_levels[np.arange(len(steps)), nearest][np.newaxis] * WEIGHTS[:, np.newaxis]
+    cube = (nearest[:, np.newaxis, np.newaxis] * 36 + nearest[np.newaxis, :, np.newaxis] * 6
+            + nearest[np.newaxis, np.newaxis, :]).ravel()
+    cube_distance = (channel[0][:, np.newaxis, np.newaxis] + channel[1][np.newaxis, :, np.newaxis]
+                     + channel[2][np.newaxis, np.newaxis, :]).ravel()
+
+    grid = np.stack(np.meshgrid(steps, steps, steps, indexing='ij'), axis=-1).reshape(-1, 3)
+    grays = _weighted_distances(grid, xterm_256()[16 + 216:])
+    gray = grays.argmin(axis=1)
+    gray_distance = grays[np.arange(len(grid)), gray]
+    return np.where(gray_distance < cube_distance, 216 + gray, cube).astype('uint8')
+
+
+def quantize(colors, palette):
+    """Map (..., 3) uint8 colors to palette entries in a single lookup."""
+    if isinstance(palette, str):
+        palette = get_palette(palette)
+    colors = np.asarray(colors, dtype='uint8') >> (8 - LUT_BITS)
+    key = (colors[..., 0].astype('int32') << (2 * LUT_BITS)) | (colors[..., 1].astype('int32') << LUT_BITS) | colors[..., 2]
+    return palette.lut[key]
+
+
+def _chars_to_str(chars):
+    return np.array([chr(c) for c in chars.ravel()], dtype=object).reshape(chars.shape)
+
+
+def repeated_mask(colors, tolerance=0, breaks=None):
+    """Find cells whose color escape may be skipped, because it is already active.
+
+    Each row starts after a reset, so the first cell of a row is never skipped.
+    Neither are the cells marked in the optional `breaks` mask.
+    With `tolerance` > 0 a color is merged into the last emitted one if none of
+    the channels differs by more than `tolerance`.
+    """
+    colors = np.asarray(colors, dtype='int16')
+    repeated = np.zeros(colors.shape[:2], dtype='bool')
+    if tolerance <= 0 or colors.shape[1] == 0:
+        repeated[:, 1:] = np.all(colors[:, 1:] == colors[:, :-1], axis=-1)
+        if breaks is not None:
+            repeated &= ~breaks
+        return repeated
+
+    # The reference is the last emitted color, so this is sequential along a row,
+    # but all rows are swept at once, a column at a time
+    anchor = colors[:, 0].copy()
+    for x in range(1, colors.shape[1]):
+        current = colors[:, x]
+        same = np.all(np.abs(current - anchor) <= tolerance, axis=-1)
+        if breaks is not None:
+            same &= ~breaks[:, x]
+        repeated[:, x] = same
+        anchor[~same] = current[~same]
+    return repeated
+
+
+class AnsiEncoder:
+    """Encodes (chars, fgs, bgs) frames into ANSI terminal output.
+
+    sentinel - string put before each cell (e.g. LTR override to fix Arabic script)
+    skip_repeated - emit a color escape only when the color actually changes
+    tolerance - with skip_repeated, treat colors differing by at most that much per channel as equal
+    palette - None for 24-bit colors, or a name of palette (see `get_palette`) to quantize the colors to
+
+    The encoder keeps a tally of bytes written and of bytes saved by skipping
+    repeated escapes in `bytes_written` and `bytes_saved`.
+    """
+    def __init__(self, sentinel=DEFAULT_SENTINEL, skip_repeated=False, tolerance=0, encoding='utf8',
+            palette=None):
+        self.sentinel = sentinel
+        self.skip_repeated = skip_repeated
+        self.tolerance = tolerance
+        self.palette = get_palette(palette) if palette is not None else None
+        self.encoding = encoding
+        self.bytes_written = 0
+        self.bytes_saved = 0
+
+    def _escapes(self, back, colors, breaks=None, emitted=None):
+        if self.palette is None:
+            escapes = _lookup(BACK_TABLES if back else FORE_TABLES, colors)
+        else:
+            entries = quantize(colors, self.palette)
+            escapes = (self.palette.back if back else self.palette.fore)[entries]
+            colors = self.palette.rgb[entries]
+        if not self.skip_repeated:
+            return escapes
+        repeated = repeated_mask(colors, self.tolerance, breaks)
+        # Escapes are pure ASCII, so string length is the byte length
+        saved = repeated if emitted is None else repeated & emitted
+        self.bytes_saved += sum(map(len, escapes[saved].tolist()))
+        escapes[repeated] = ''
+        return escapes
+
+    def cells(self, chars, fgs, bgs, breaks=None, emitted=None):
+        """Compute the string emitted for each cell as an (rows, cols) object array.
+
+        chars - (rows, cols) code points
+        fgs, bgs - (rows, cols, 3) uint8 colors or None
+        breaks - optional (rows, cols) mask of cells starting after a reset
+        emitted - optional (rows, cols) mask of cells that will be written, for the `bytes_saved` tally
+        """
+        cells = _chars_to_str(chars)
+        if bgs is not None:
+            cells = self._escapes(True, bgs, breaks, emitted) + cells
+        if fgs is not None:
+            cells = self._escapes(False, fgs, breaks, emitted) + cells
+        if self.sentinel:
+            cells = self.sentinel + cells
+        return cells
+
+    def lines(self, chars, fgs, bgs):
+        """Terminal lines of the frame, each ending with a reset, without newlines."""
+        return [''.join(row) + RESET for row in self.cells(chars, fgs, bgs).tolist()]
+
+    def encode(self, chars, fgs, bgs):
+        """Encode a whole frame into a single bytes buffer."""
+        data = ''.join([line + '\n' for line in self.lines(chars, fgs, bgs)]).encode(self.encoding)
+        self.bytes_written += len(data)
+        return data
+
+
+def changed_cells(previous, current):
+    """Compare two (chars, fgs, bgs) frames, returning (rows, cols) mask of the changed cells.
+
+    None is returned, when the frames are not comparable (e.g. there is no previous frame).
+    """
+    if previous is None:
+        return None
+    chars, fgs, bgs = current
+    prev_chars, prev_fgs, prev_bgs = previous
+    if chars.shape != prev_chars.shape or (fgs is None) != (prev_fgs is None) or (bgs is None) != (prev_bgs is None):
+        return None
+    changed = chars != prev_chars
+    if fgs is not None:
+        changed |= np.any(fgs != prev_fgs, axis=-1)
+    if bgs is not None:
+        changed |= np.any(bgs != prev_bgs, axis=-1)
+    return changed
+
+
+def changed_runs(changed, merge_gap=0):
+    """Find horizontal runs of changed cells.
+
+    Runs separated by at most `merge_gap` unchanged cells are merged,
+    as redrawing a few cells is cheaper than moving the cursor.
+    Returns (rows, starts, ends) arrays, ends are exclusive.
+    """
+    padded = np.zeros((changed.shape[0], changed.shape[1] + 2), dtype='int8')
+    padded[:, 1:-1] = changed
+    edges = np.diff(padded, axis=1)
+    # Both are in row-major order, so n-th start matches n-th end
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    if len(rows) > 1:
+        separate = (rows[1:] != rows[:-1]) | (starts[1:] - ends[:-1] > merge_gap)
+        first = np.concatenate([[True], separate])
+        last = np.concatenate([separate, [True]])
+        rows, starts, ends = rows[first], starts[first], ends[last]
+    return rows, starts, ends
+
+
+class DiffEncoder(AnsiEncoder):
+    """Encodes a sequence of frames, emitting only the cells changed since the previous frame.
+
+    Changed runs of cells are prefixed with absolute cursor positioning, so the
+    frame is placed at `origin` – (row, col), 0-based – of the screen.
+    The whole frame is redrawn, when it is the first one, its shape changed, or
+    more than `threshold` fraction of the cells changed.
+
+    merge_gap - number of unchanged cells between changed runs that will be redrawn instead of moving the cursor
+    """
+    def __init__(self, *args, threshold=0.5, origin=(0, 0), merge_gap=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+        self.origin = origin
+        self.merge_gap = merge_gap
+        self.previous = None
+        self.full_redraws = 0
+
+    def reset(self):
+        """Forget the previous frame, e.g. after the screen was cleared."""
+        self.previous = None
+
+    def _goto(self, y, x):
+        return '\x1b[%d;%dH' % (self.origin[0] + y + 1, self.origin[1] + x + 1)
+
+    def encode(self, chars, fgs, bgs):
+        """Encode changes to the previous frame into a single bytes buffer."""
+        changed = changed_cells(self.previous, (chars, fgs, bgs))
+        if changed is None or changed.mean() > self.threshold:
+            self.full_redraws += 1
+            rows = np.arange(chars.shape[0])
+            starts = np.zeros_like(rows)
+            ends = np.full_like(rows, chars.shape[1])
+        else:
+            rows, starts, ends = changed_runs(changed, self.merge_gap)
+
+        self.previous = (chars.copy(),
+                         fgs.copy() if fgs is not None else None,
+                         bgs.copy() if bgs is not None else None)
+        if len(rows) == 0:
+            return b''
+
+        breaks = np.zeros(chars.shape, dtype='bool')
+        breaks[rows, starts] = True
+        # +1 at run starts, -1 past run ends, so that cumsum marks the runs
+        bounds = np.zeros((chars.shape[0], chars.shape[1] + 1), dtype='int8')
+        bounds[rows, starts] += 1
+        bounds[rows, ends] -= 1
+        emitted = np.cumsum(bounds, axis=1)[:, :-1] > 0
+        cells = self.cells(chars, fgs, bgs, breaks, emitted).tolist()
+        data = ''.join([self._goto(y, x0) + ''.join(cells[y][x0:x1]) + RESET
+                        for y, x0, x1 in zip(rows.tolist(), starts.tolist(), ends.tolist())])
+        data = data.encode(self.encoding)
+        self.bytes_written += len(data)
+        return data
+
+
+def encode_ansi(chars, fgs, bgs, sentinel=DEFAULT_SENTINEL, encoding='utf8', skip_repeated=False, tolerance=0,
+        palette=None):
+    """Encode a whole frame into a single bytes buffer.
+
+    Without skip_repeated the output is identical to writing `term_fore`,
+    `term_back` and the character cell by cell, but the escapes are taken from
+    precomputed tables and concatenated in bulk.
+    """
+    return AnsiEncoder(sentinel, skip_repeated, tolerance, encoding, palette).encode(chars, fgs, bgs)
+
+
+def write_ansi(f, data, encoding='utf8'):
+    """Write encoded frame to either a binary or a text stream."""
+    if isinstance(f, io.TextIOBase):
+        f.write(data.decode(encoding))
+    else:
+        f.write(data)
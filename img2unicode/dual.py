@@ -1,4 +1,9 @@
-"""Optimizers that use both foreground and background."""
+"""Optimizers that use both foreground and background.
+
+The template-based optimizers take `dtype`, e.g. 'float32' to halve the memory traffic,
+in which the templates, the matrices derived from them and the input pieces are kept.
+By default the dtype of the templates is used.
+"""
 from abc import ABC, abstractmethod, abstractproperty
 
 import numpy as np
@@ -6,7 +11,7 @@ import skimage
 import skimage.transform
 
 from img2unicode.templates import get_16x8_flat
-from img2unicode.utils import cubify
+from img2unicode.utils import as_dtype, cubify, masked_histogram_median, masked_median
 
 
 class BaseDualOptimizer(ABC):
@@ -25,6 +30,21 @@ class BaseDualOptimizer(ABC):
         chars, fgs, bgs = zip(*[self.optimize_char(c) for c in pieces])
         return np.array(chars), np.array(fgs), np.array(bgs)
 
+    def split_pieces(self, img):
+        """Cut the image into per-cell pieces, each of them optimized independently by `optimize_pieces`."""
+        return cubify(img, (16, 8) if len(img.shape) == 2 else (16, 8, 3)),
+
+    def optimize_pieces(self, pieces):  # (n, 16, 8) or (n, 16, 8, 3)
+        """Optimize arbitrary pieces, returning flat (n,) chars and (n, 3) colors."""
+        if hasattr(self, 'optimize_image'):
+            return self.optimize_image(pieces)
+        # Lay the pieces out in a single row of cells
+        strip = np.swapaxes(pieces, 0, 1).reshape(16, -1, *pieces.shape[3:])
+        chars, fgs, bgs = self.optimize_chunk(strip)
+        return (np.asarray(chars).reshape(-1),
+                np.asarray(fgs).reshape(-1, 3) if fgs is not None else None,
+                np.asarray(bgs).reshape(-1, 3) if bgs is not None else None)
+
 
 class HalfBlockDualOptimizer(BaseDualOptimizer):
     """This is very simple, since we use the block is predefined.
@@ -85,7 +105,7 @@ class FastQuadDualOptimizer(BaseDualOptimizer):
 
     # full block is achieved by setting the same fg and bg
 
-    def __init__(self, _charmask=None, _templates=None):
+    def __init__(self, _charmask=None, _templates=None, dtype=None):
         #         t16x8, indexer = get_16x8(templates, QUADS)
         #         masks = np.round(masks[:, 8*2+2::8*3+4]) # take a pixel from each quadrant
         masks = np.array([[1., 1., 0., 0.],
@@ -94,7 +114,8 @@ class FastQuadDualOptimizer(BaseDualOptimizer):
                              [0., 0., 0., 1.],
                              [1., 0., 0., 0.],
                              [0., 1., 0., 0.],
-                             [1., 0., 0., 1.]])
+                             [1., 0., 0., 1.]], dtype=dtype)
+        self.dtype = dtype
         self.masks = masks
         self.db1 = np.nan_to_num(
             (masks / np.sqrt(np.sum(masks, axis=1))[:, np.newaxis]))
@@ -106,7 +127,7 @@ class FastQuadDualOptimizer(BaseDualOptimizer):
         return len(self.QUADS)
 
     def optimize_chunk(self, img):
-        img = skimage.transform.downscale_local_mean(img, (8, 4, 1))
+        img = skimage.transform.downscale_local_mean(as_dtype(img, self.dtype), (8, 4, 1))
         imgc = cubify(img, (2, 2, 3)).reshape(-1, 4, 3)
         masks = self.masks
 
@@ -134,12 +155,27 @@ class ExactGenericDualOptimizer(BaseDualOptimizer):
     $$ bg_i = \frac{\sum_p ( (1-cs_{i,p}) * s_p)}{\sum_p 1-cs_{i,p}} == \frac{(1-cs_i) \cdot s}{|1-cs_i|} $$
     with the assumption, that 0/0 is 0.
 
+    Expanding the square, the objective for a channel is
+    $$ fg_i^2 |cs_i^2| + bg_i^2 |(1-cs_i)^2| + 2 fg_i bg_i |cs_i (1-cs_i)| - 2 fg_i (cs_i \cdot s) - 2 bg_i ((1-cs_i) \cdot s) + |s^2| $$
+    so `optimize_image` needs only the template sums and the products $cs \cdot s$ of all pieces at once.
+    The expansion cancels |s^2| against the other terms, so unless dtype is given, it is computed in float64.
+
     """
+    # Upper bound of the number of (piece channel, template) objectives computed at once by optimize_image
+    BATCH_ELEMENTS = 2**22
 
-    def __init__(self, charmask=None, templates=None):
+    def __init__(self, charmask=None, templates=None, dtype=None):
         cs, indexer = get_16x8_flat(templates, charmask)
-        self.cs = cs
+        self.dtype = dtype
+        self.cs = as_dtype(cs, dtype)
         self.indexer = indexer
+        # Templates in the dtype of optimize_image
+        self._cs = cs = as_dtype(cs, dtype or 'float64')
+        self.fg_sum = cs.sum(axis=1)
+        self.bg_sum = (1 - cs).sum(axis=1)
+        self.fg_sq = (cs**2).sum(axis=1)
+        self.bg_sq = ((1 - cs)**2).sum(axis=1)
+        self.fg_bg = (cs * (1 - cs)).sum(axis=1)
 
     @property
     def n_chars(self):
@@ -147,7 +183,7 @@ class ExactGenericDualOptimizer(BaseDualOptimizer):
 
     def optimize_char(self, piece):
         cs = self.cs
-        s = piece.reshape(-1, 3)
+        s = as_dtype(piece, self.dtype).reshape(-1, 3)
         with np.errstate(divide='ignore', invalid='ignore'):
             fc = np.nan_to_num(
                 np.clip((cs @ s) / cs.sum(axis=1)[:, np.newaxis], 0, 1))
@@ -166,6 +202,33 @@ class ExactGenericDualOptimizer(BaseDualOptimizer):
         idx = self.indexer[res[0]]
         return idx, fc[res[0]], bg[res[0]]
 
+    def optimize_image(self, img):
+        Q = as_dtype(img, self._cs.dtype).reshape(-1, 16 * 8, 3)
+        B, channels = len(Q), Q.shape[2]
+        rows = np.ascontiguousarray(Q.transpose(0, 2, 1)).reshape(B * channels, 16 * 8)
+        sums = rows.sum(axis=1)
+        squares = (rows**2).sum(axis=1)
+
+        chars = np.zeros(B, dtype='int')
+        fgs = np.zeros((B, channels), dtype=Q.dtype)
+        bgs = np.zeros_like(fgs)
+        step = max(1, self.BATCH_ELEMENTS // (channels * len(self._cs)))
+        for start in range(0, B, step):
+            r = slice(start * channels, (start + step) * channels)
+            fg_dot = rows[r] @ self._cs.T
+            bg_dot = sums[r, np.newaxis] - fg_dot
+            # 0/0 is 0, whatever the rounding of bg_dot for full templates
+            fg = np.clip(np.divide(fg_dot, self.fg_sum, out=np.zeros_like(fg_dot), where=self.fg_sum > 0), 0, 1)
+            bg = np.clip(np.divide(bg_dot, self.bg_sum, out=np.zeros_like(bg_dot), where=self.bg_sum > 0), 0, 1)
+            error = fg * (fg * self.fg_sq + 2 * (bg * self.fg_bg - fg_dot)) + bg * (bg * self.bg_sq - 2 * bg_dot)
+            error += squares[r, np.newaxis]
+            b = len(error) // channels
+            best = error.reshape(b, channels, -1).sum(axis=1).argmin(axis=1)
+            chars[start:start+b] = best
+            fgs[start:start+b] = fg.reshape(b, channels, -1)[np.arange(b), :, best]
+            bgs[start:start+b] = bg.reshape(b, channels, -1)[np.arange(b), :, best]
+        return self.indexer[chars], fgs, bgs
+
 class FastGenericDualOptimizer(BaseDualOptimizer):
     """
         Here we optimize the following function:
@@ -190,35 +253,192 @@ class FastGenericDualOptimizer(BaseDualOptimizer):
 
         $$ char(j, S) = argmax_i ((C_i*S)^2+(C'_i*S)^2)_{i,j}$$
 
+        With use_median, the colors are medians of the pixels under the template (thresholded at 0.5)
+        and its complement instead of the averages. median_bins computes them approximately from
+        histograms of that many levels instead of sorting each block (exactly for uint8 images).
+
+        batch_bytes bounds the memory of the scores, see `best_chars`.
+
+        For large charsets, index='approximate' clusters the templates at construction and scores
+        each block only against the templates of its `probes` clusters with the highest upper bound
+        of their scores, skipping those that cannot beat the best template found so far.
+        The chosen char is then not always the best one, see examples/benchmark_index.py.
+        n_clusters defaults to sqrt(T).
+
     """
 
-    def __init__(self, charmask=None, templates=None, use_median=True):
+    def __init__(self, charmask=None, templates=None, use_median=True, dtype=None, median_bins=None,
+            batch_bytes=64 * 2**20, index=None, probes=8, n_clusters=None):
         cs, indexer = get_16x8_flat(templates, charmask)
+        cs = as_dtype(cs, dtype)
+        self.dtype = dtype
         self.cs = cs
         self.indexer = indexer
         self.use_median = use_median
+        self.median_bins = median_bins
+        self.batch_bytes = batch_bytes
         with np.errstate(divide='ignore', invalid='ignore'):
             self.cs1 = np.nan_to_num(
                 (cs / np.sqrt(np.sum(cs, axis=1))[:, np.newaxis]))
             self.cs2 = np.nan_to_num(
                 ((1 - cs) / np.sqrt(np.sum((1 - cs), axis=1))[:, np.newaxis]))
+        if index not in (None, 'approximate'):
+            raise ValueError("Unknown index %s" % index)
+        self.index = index
+        self.probes = probes
+        if index is not None:
+            self._build_index(n_clusters)
 
     @property
     def n_chars(self):
         return len(self.cs)
 
+    # Slack of the cluster bounds relative to the scores, in units of the epsilon of their dtype,
+    # covering the rounding errors of the scores (sums of 16*8 products)
+    BOUND_SLACK = 512
+
+    def _build_index(self, n_clusters=None):
+        r"""Cluster the templates and compute the data for the upper bounds of the scores in each cluster.
+
+        For a block channel s with mean mu and d = s - mu, the scores of all templates share a part:
+        $$ (C_i*s)^2 + (C'_i*s)^2 = P mu^2 + (u_i*d)^2, u_i = \sqrt{1/S_i + 1/(P-S_i)} (cs_i - \bar{cs_i}) $$
+        where P = 16*8 and S_i = \sum_p cs_{i,p} (u_i = 0 for S_i in {0, P}), as the cross terms sum d to 0.
+        The bounds are on |u_i*d| only, which is what tells the templates apart. For a cluster of u_i
+        with mean m, radius r and elementwise bounds lo <= u_i <= hi:
+        $$ |u_i*d| \le \min(|m*d| + r|d|, |c*d| + h*|d|) $$
+        with the center c = (hi + lo)/2 and the half widths h = (hi - lo)/2 of the box.
+        The templates are clustered by u_i.
+        """
+        from sklearn.cluster import KMeans
+
+        cs = self.cs.astype('float64')
+        P = cs.shape[1]
+        sums = cs.sum(axis=1)
+        with np.errstate(divide='ignore'):
+            weights = np.where((sums > 0) & (sums < P), 1 / sums + 1 / (P - sums), 0)
+        u = np.sqrt(weights)[:, np.newaxis] * (cs - cs.mean(axis=1, keepdims=True))
+
+        n_clusters = min(len(u), n_clusters or max(1, int(round(np.sqrt(len(u))))))
+        labels = KMeans(n_clusters=n_clusters, n_init=1, max_iter=30, random_state=0).fit_predict(u)
+        self.clusters = [members for members in (np.flatnonzero(labels == k) for k in range(n_clusters))
+                         if len(members)]
+        self._cluster_cs1 = [self.cs1[members] for members in self.clusters]
+        self._cluster_cs2 = [self.cs2[members] for members in self.clusters]
+
+        parts = [u[members] for members in self.clusters]
+        self._means = np.array([part.mean(axis=0) for part in parts])
+        self._radii = np.array([np.sqrt(np.square(part - mean).sum(axis=1)).max()
+                                for part, mean in zip(parts, self._means)])
+        lows = np.array([part.min(axis=0) for part in parts])
+        highs = np.array([part.max(axis=0) for part in parts])
+        self._centers, self._half_widths = (highs + lows) / 2, (highs - lows) / 2
+
+    def _cluster_bounds(self, rows, b):
+        """Upper bounds (b, K) of the best score in each cluster, for the blocks' channels as rows (b*c, 16*8)."""
+        # Relative rounding error of the scores, computed in this dtype
+        slack = self.BOUND_SLACK * np.finfo(np.result_type(self.cs1, rows)).eps
+        rows = rows.astype('float64')
+        mu = rows.mean(axis=1, keepdims=True)
+        d = rows - mu
+        ball = np.abs(d @ self._means.T) + np.sqrt(np.square(d).sum(axis=1))[:, np.newaxis] * self._radii
+        box = np.abs(d @ self._centers.T) + np.abs(d) @ self._half_widths.T
+        bounds = np.square(np.minimum(ball, box))
+        bounds += rows.shape[1] * np.square(mu)
+        bounds = bounds.reshape(b, -1, len(self.clusters)).sum(axis=1)
+        return bounds * (1 + slack)
+
+    def _visit_cluster(self, k, selected, rows, best_score, best):
+        """Score the templates of cluster k against the selected blocks, updating their best ones in place."""
+        r = rows[selected].reshape(-1, rows.shape[2])
+        scores = np.square(r @ self._cluster_cs1[k].T)
+        scores += np.square(r @ self._cluster_cs2[k].T)
+        scores = scores.reshape(len(selected), rows.shape[1], -1).sum(axis=1)
+        top = scores.argmax(axis=1)
+        top_score = scores[np.arange(len(selected)), top]
+        chars = self.clusters[k][top]
+        # Ties go to the lower index, as with a single argmax
+        better = (top_score > best_score[selected]) | ((top_score == best_score[selected]) & (chars < best[selected]))
+        best_score[selected[better]] = top_score[better]
+        best[selected[better]] = chars[better]
+
+    def _search_index(self, Q):
+        """Approximate `best_chars` visiting the `probes` most promising clusters, see `_build_index`."""
+        B, K = len(Q), len(self.clusters)
+        dtype = np.result_type(self.cs1, Q)
+        pairs = max(1, self.batch_bytes // (dtype.itemsize * 8))
+        block_tile = max(1, min(B, max(64, pairs // max(len(members) for members in self.clusters))))
+
+        best_char = np.zeros(B, dtype='int')
+        for start in range(0, B, block_tile):
+            q = Q[start:start+block_tile]
+            b = len(q)
+            rows = np.ascontiguousarray(q.transpose(0, 2, 1))
+            bounds = self._cluster_bounds(rows.reshape(-1, rows.shape[2]), b)
+            order = np.argsort(-bounds, axis=1, kind='stable')[:, :self.probes]
+            best_score = np.full(b, -np.inf)
+            best = np.zeros(b, dtype='int')
+            active = np.arange(b)
+            for probe in range(min(self.probes, K)):
+                candidates = order[active, probe]
+                # Equal bounds are still visited, a template with a lower index may tie the best one
+                keep = bounds[active, candidates] >= best_score[active]
+                active, candidates = active[keep], candidates[keep]
+                if not len(active):
+                    break
+                for k in np.unique(candidates):
+                    self._visit_cluster(k, active[candidates == k], rows, best_score, best)
+            best_char[start:start+b] = best
+        return best_char
+
+    def best_chars(self, Q):
+        """argmax_i ((C_i*S)^2+(C'_i*S)^2) for each of Q (B, 16*8, 3).
+
+        Scores are computed in tiles of blocks and templates. In a tile, the channels of the blocks
+        are rows of a single (3*b, 16*8) matrix, multiplied by C and C' with one GEMM each.
+        A running argmax is kept across template tiles, so the memory stays around batch_bytes
+        whatever the number of templates and blocks.
+        """
+        if self.index is not None:
+            return self._search_index(Q)
+        B, N = len(Q), len(self.cs1)
+        dtype = np.result_type(self.cs1, Q)
+        # Per (template, block) pair: 2*3 products and a score
+        pairs = max(1, self.batch_bytes // (dtype.itemsize * 8))
+        block_tile = max(1, min(B, max(64, pairs // max(N, 1))))
+        template_tile = min(N, max(1, pairs // max(block_tile, 1)))
+
+        best_char = np.zeros(B, dtype='int')
+        for start in range(0, B, block_tile):
+            q = Q[start:start+block_tile]
+            b = len(q)
+            rows = np.ascontiguousarray(q.transpose(0, 2, 1)).reshape(b * q.shape[2], q.shape[1])
+            best_score = np.full(b, -np.inf)
+            best = np.zeros(b, dtype='int')
+            for first in range(0, N, template_tile):
+                scores = np.square(rows @ self.cs1[first:first+template_tile].T)
+                scores += np.square(rows @ self.cs2[first:first+template_tile].T)
+                scores = scores.reshape(b, q.shape[2], -1).sum(axis=1)
+                tile_best = scores.argmax(axis=1)
+                tile_score = scores[np.arange(b), tile_best]
+                # Strictly better only, so ties go to the first template as with a single argmax
+                better = tile_score > best_score
+                best_score[better] = tile_score[better]
+                best[better] = tile_best[better] + first
+            best_char[start:start+b] = best
+        return best_char
+
     def optimize_image(self, img):
-        Q = img.reshape(-1, 16 * 8, 3)
-        best_char = np.argmax(
-            ((self.cs1 @ Q) ** 2 + (self.cs2 @ Q) ** 2).sum(axis=2), 1)
+        Q = as_dtype(img, self.dtype).reshape(-1, 16 * 8, 3)
+        best_char = self.best_chars(Q)
         best_masks = self.cs[best_char][:, :, np.newaxis]
 
         with np.errstate(divide='ignore', invalid='ignore'):
             if self.use_median:
-                fg = (np.where(best_masks>0.5, 1, np.nan))*Q
-                fg = np.nanmedian(fg, axis=1)
-                bg = (np.where(best_masks<0.5, 1, np.nan))*Q
-                bg = np.nanmedian(bg, axis=1)
+                masks = best_masks[:, :, 0]
+                if self.median_bins:
+                    fg, bg = masked_histogram_median(Q, [masks > 0.5, masks < 0.5], self.median_bins)
+                else:
+                    fg, bg = masked_median(Q, [masks > 0.5, masks < 0.5])
             else:
                 fg = np.clip(np.sum(best_masks * Q, axis=1) / best_masks.sum(axis=1), 0, 1)
                 bg = np.clip(np.sum((1 - best_masks) * Q, axis=1) / (1 - best_masks).sum(axis=1), 0, 1)
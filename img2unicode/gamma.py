@@ -1,8 +1,15 @@
+import collections
+import hashlib
+import logging
+import os
+import time
+
 import numpy as np
 import skimage.transform
-from sklearn.neighbors import NearestNeighbors
 
+from img2unicode.ann import available_backends, get_backend
 from img2unicode.templates import get_16x16, DEFAULT_TEMPLATES, normalize_mask
+from img2unicode.utils import as_dtype, cache_dir, write_cache
 
 
 class BasicGammaOptimizer:
@@ -18,13 +25,17 @@ class BasicGammaOptimizer:
 
     Foreground color is achieved by first normalizing the example, matching,
     and then applying color.
+
+    dtype - if set, e.g. 'float32', the templates and the pieces are kept in that dtype,
+            otherwise the templates are used as stored and the pieces in the dtype of the images
     """
-    def __init__(self, use_color=True, charmask=None, templates=DEFAULT_TEMPLATES):
+    def __init__(self, use_color=True, charmask=None, templates=DEFAULT_TEMPLATES, dtype=None):
         self.use_color = use_color
+        self.dtype = dtype
         bigs = templates.raw_16x16
         self.bigs = bigs
-        self.bigs2 = templates.base_16x16
-        wide_mask = np.tile(np.repeat([0, 1], 8), (16, 1))
+        self.bigs2 = as_dtype(templates.base_16x16, dtype)
+        wide_mask = as_dtype(np.tile(np.repeat([0, 1], 8), (16, 1)), dtype)
         almost_thin_mask = wide_mask.copy()
         almost_thin_mask[:, 8:10] = 0
         self.wide_mask = wide_mask
@@ -46,59 +57,133 @@ class BasicGammaOptimizer:
 
         self.athin_bigs2, self.athin_bigse, self.athin_idx = get_16x16(templates, athin_idx_m, return_edges=True)
         self.thin_bigs2, self.thin_bigse, self.thin_idx = get_16x16(templates, thin_idx_m, return_edges=True)
+        self.athin_bigs2, self.athin_bigse = as_dtype(self.athin_bigs2, dtype), as_dtype(self.athin_bigse, dtype)
+        self.thin_bigs2, self.thin_bigse = as_dtype(self.thin_bigs2, dtype), as_dtype(self.thin_bigse, dtype)
 
 
     @property
     def n_chars(self):
         return len(self.athin_idx) + len(self.thin_idx)
 
+    # Upper bound of the number of (cell, template) distances computed at once by search_batch
+    BATCH_ELEMENTS = 2**22
+
     def search(self, t, te, bigs2, bigse):
-        c = (np.abs(bigs2 - t)**2).sum(axis=1).sum(axis=1) + np.abs(bigse-te).sum(axis=1).sum(axis=1)/10
-        chr = np.argmin(c)
-        res = chr, c[chr]
-        return res
-
-    def _optimize_char(self, t, te):
-
-        thin_masked = t-(t*self.wide_mask)
-        athin_masked = t-(t*self.almost_thin_mask)
-        te_athin_masked = te-(te*self.almost_thin_mask_half)
-
-
-        arc, ars = self.search(athin_masked, te_athin_masked, self.athin_bigs2, self.athin_bigse)
-        rc, rs =  self.search(thin_masked, te_athin_masked, self.thin_bigs2, self.thin_bigse)
-        res_c = self.thin_idx[rc] if rs <= ars else self.athin_idx[arc]
-        return res_c
-
-    def _optimize_chunk(self, img_gray, img_edges, imgc=None):
-        for x in range(img_gray.shape[0]//16):
-            for y in range(img_gray.shape[1]//8-1):
-                # XXX: 8-1 = render the last vertical line somehow
-                piece_gray = img_gray[x*16:(x+1)*16, y*8:(y+2)*8]
-                if self.use_color:
-                    piece_gray /= piece_gray.max()+1e-5
-                piece_edges = img_edges[x*8:(x+1)*8, y*4:(y+2)*4]
-
-                res = self._optimize_char(piece_gray, piece_edges)
-                if self.use_color:
-                    piece_color = imgc[x*16:(x+1)*16, y*8:(y+2)*8]
-                    with np.errstate(divide='ignore', invalid='ignore'):
-                        color = np.nan_to_num(((piece_color*self.bigs2[res][:,:,np.newaxis]).sum(axis=0).sum(axis=0)/self.bigs2[res].sum()).clip(0.,1.))
-                    background = np.array([0., 0., 0.]) # black
-                else:
-                    color = None
-                    background = None
-                yield res, color, background
+        """`search_batch` for a single piece t - (16, 16), te - (8, 8)."""
+        chars, dists = self.search_batch(t[np.newaxis], te[np.newaxis], bigs2, bigse)
+        return chars[0], dists[0]
+
+    def search_batch(self, T, TE, bigs2, bigse):
+        """Nearest templates of many pieces at once: T - (B, 16, 16), TE - (B, 8, 8).
+
+        The distance is the squared difference of the pieces plus a tenth of the absolute difference of the edges.
+        It is first computed with matrix products as |t|^2 - 2 t.b + |b|^2, and then all templates
+        within rounding error of the best are re-scored directly, so the result is exactly the argmin.
+        """
+        Tf = T.reshape(len(T), -1)
+        TEf = TE.reshape(len(TE), -1)
+        B = bigs2.reshape(len(bigs2), -1)
+        BE = bigse.reshape(len(bigse), -1)
+        B_sq = (B.astype(Tf.dtype)**2).sum(axis=1)
+        BE_sum = BE.sum(axis=1)
+        # |b - t| == b + t - 2 t.b for t in {0, 1} and b in [0, 1], which is the case of canny edges
+        edges_linear = BE.min(initial=0) >= 0 and BE.max(initial=0) <= 1 and np.all((TEf == 0) | (TEf == 1))
+
+        chars = np.empty(len(T), dtype='int')
+        dists = np.empty(len(T), dtype=Tf.dtype)
+        step = max(1, self.BATCH_ELEMENTS // max(1, len(B)))
+        for start in range(0, len(T), step):
+            t, te = Tf[start:start+step], TEf[start:start+step]
+            t_sq = (t**2).sum(axis=1)
+            c = t_sq[:, np.newaxis] - 2 * (t @ B.T) + B_sq
+            if edges_linear:
+                c += (te.sum(axis=1)[:, np.newaxis] + BE_sum - 2 * (te @ BE.T)) / 10
+            else:
+                c += np.abs(BE[np.newaxis] - te[:, np.newaxis]).sum(axis=2) / 10
+
+            margin = max(1e-9, 64 * np.finfo(c.dtype).eps) * (1 + t_sq + B_sq.max() + te.sum(axis=1) + BE_sum.max())
+            rows, cands = np.nonzero(c <= (c.min(axis=1) + margin)[:, np.newaxis])
+            exact = (np.abs(bigs2[cands] - T[start + rows])**2).sum(axis=1).sum(axis=1) + \
+                np.abs(bigse[cands] - TE[start + rows]).sum(axis=1).sum(axis=1)/10
+            # Candidates are sorted by row, then template, so the first minimum per row is the one argmin gives
+            order = np.lexsort((np.arange(len(exact)), exact, rows))
+            first = np.concatenate([[True], rows[order][1:] != rows[order][:-1]])
+            best = order[first]
+            chars[start:start+step] = cands[best]
+            dists[start:start+step] = exact[best]
+        return chars, dists
+
+    def _pieces(self, img_gray, img_edges):
+        """Cut the images into overlapping (16, 16) pieces and matching (8, 8) edge pieces.
+
+        Each piece spans its cell and the next one, hence there is one piece less than cells in a row.
+        With colors, a piece is normalized by its maximum. This is done in place and in order,
+        so the left half of a piece was already divided when normalizing the previous piece.
+        """
+        img_gray, img_edges = as_dtype(img_gray, self.dtype), as_dtype(img_edges, self.dtype)
+        rows, cols = img_gray.shape[0]//16, img_gray.shape[1]//8-1
+        # XXX: 8-1 = render the last vertical line somehow
+        blocks = img_gray[:rows*16, :(cols+1)*8].reshape(rows, 16, cols+1, 8).transpose(0, 2, 1, 3)
+        left, right = blocks[:, :-1], blocks[:, 1:]
+        if self.use_color and cols > 0:
+            maxes = blocks.max(axis=3).max(axis=2)
+            divisors = np.empty((rows, cols), dtype=maxes.dtype)
+            previous = np.ones(rows, dtype=maxes.dtype)
+            for y in range(cols):
+                divisors[:, y] = np.maximum(maxes[:, y] / previous, maxes[:, y+1]) + 1e-5
+                previous = divisors[:, y]
+            left = left / np.concatenate([np.ones((rows, 1), dtype=divisors.dtype), divisors[:, :-1]], axis=1)[:, :, np.newaxis, np.newaxis]
+            left = left / divisors[:, :, np.newaxis, np.newaxis]
+            right = right / divisors[:, :, np.newaxis, np.newaxis]
+        pieces = np.concatenate([left, right], axis=3).reshape(-1, 16, 16)
+
+        edges = img_edges[:rows*8, :(cols+1)*4].reshape(rows, 8, cols+1, 4).transpose(0, 2, 1, 3)
+        edge_pieces = np.concatenate([edges[:, :-1], edges[:, 1:]], axis=3).reshape(-1, 8, 8)
+        return pieces, edge_pieces
+
+    def _color_pieces(self, imgc):
+        imgc = as_dtype(imgc, self.dtype)
+        rows, cols = imgc.shape[0]//16, imgc.shape[1]//8-1
+        blocks = imgc[:rows*16, :(cols+1)*8].reshape(rows, 16, cols+1, 8, 3).transpose(0, 2, 1, 3, 4)
+        return np.concatenate([blocks[:, :-1], blocks[:, 1:]], axis=3).reshape(-1, 16, 16, 3)
+
+    def _colors(self, pieces, chars):
+        """Average color of the pieces under the chosen templates."""
+        masks = self.bigs2[chars]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.nan_to_num(((pieces*masks[:, :, :, np.newaxis]).sum(axis=1).sum(axis=1)
+                                  / masks.reshape(len(masks), -1).sum(axis=1)[:, np.newaxis]).clip(0., 1.))
+
+    def split_pieces(self, img_gray, img_edges, imgc=None):
+        """Cut the images into per-cell pieces, each of them optimized independently by `optimize_pieces`."""
+        T, TE = self._pieces(img_gray, img_edges)
+        if not self.use_color:
+            return T, TE
+        return T, TE, self._color_pieces(imgc)
+
+    def optimize_pieces(self, T, TE, C=None):
+        thin_masked = T-(T*self.wide_mask)
+        athin_masked = T-(T*self.almost_thin_mask)
+        te_athin_masked = TE-(TE*self.almost_thin_mask_half)
+
+        start = time.perf_counter()
+        arc, ars = self.search_batch(athin_masked, te_athin_masked, self.athin_bigs2, self.athin_bigse)
+        rc, rs = self.search_batch(thin_masked, te_athin_masked, self.thin_bigs2, self.thin_bigse)
+        chars = np.where(rs <= ars, self.thin_idx[rc], self.athin_idx[arc])
+        elapsed = time.perf_counter() - start
+        # Throughput of the search, i.e. the last optimize_chunk call
+        self.cells_per_second = len(T) / max(elapsed, 1e-9)
+        logging.debug("%s searched %d cells in %.3fs (%.0f cells/s)",
+                      type(self).__name__, len(T), elapsed, self.cells_per_second)
+
+        if not self.use_color:
+            return chars, None, None
+        fgs = self._colors(C, chars)
+        bgs = np.zeros_like(fgs) # black
+        return chars, fgs, bgs
 
     def optimize_chunk(self, img_gray, img_edges, imgc=None):
-        chars, fgs, bgs =zip(*list(self._optimize_chunk(img_gray, img_edges, imgc)))
-        fgs =  np.array(fgs)
-        if fgs.ravel()[0] is None:
-            fgs = None
-        bgs = np.array(bgs)
-        if bgs.ravel()[0] is None:
-            bgs = None
-        return np.array(chars), fgs, bgs
+        return self.optimize_pieces(*self.split_pieces(img_gray, img_edges, imgc))
 
 
 
@@ -113,54 +198,191 @@ class ExactGammaOptimizer(BasicGammaOptimizer):
     $$argmin_i (cs' - s')^2$$
 
     That can be solved for instance using kd_tree.
+
+    backend - name of a nearest neighbour backend registered in `ann.BACKENDS`, or a backend instance;
+              BACKEND of the class by default
+    components - if set, the templates are projected on that many principal components, the index
+                 searches the `rerank` nearest candidates in the reduced space, and the best of them
+                 is chosen by the exact distance in the full space
+
+    Built indexes are saved in the cache directory (see `utils.cache_dir`), keyed by the
+    template data and index parameters, and loaded from there by the next constructions.
+    Pass cache=False to always build them.
+
+    All pieces of an image are sent as one batched query per index, using `n_jobs` threads
+    (-1 means all cores).
     """
-    def __init__(self, *args, **kwargs):
+    BACKEND = 'sklearn'
+    # Upper bound of the number of candidate elements compared at once when re-ranking
+    BATCH_ELEMENTS = 2**22
+
+    def __init__(self, *args, cache=True, n_jobs=-1, backend=None, components=None, rerank=16, **kwargs):
+        self.cache = cache
+        self.n_jobs = n_jobs
+        self.components = components
+        self.rerank = rerank
         super().__init__(*args, **kwargs)
+        self.backend = self.choose_backend(backend)
         self.athin_bigs2 = self.build_nn(self.athin_bigs2, self.athin_bigse)
         self.thin_bigs2 = self.build_nn(self.thin_bigs2, self.thin_bigse)
 
+    def choose_backend(self, backend=None):
+        if backend is None:
+            backend = self.BACKEND
+        return get_backend(backend) if isinstance(backend, str) else backend
+
+    def index_params(self):
+        return dict(backend=self.backend.name, **self.backend.params())
+
+    @staticmethod
+    def _dataset(bigs2, bigse):
+        return np.concatenate([bigs2.reshape(bigs2.shape[0], -1), bigse.reshape(bigse.shape[0], -1)/10], axis=1)
+
+    @staticmethod
+    def _cache_key(dataset, params):
+        key = hashlib.sha1(repr((dataset.shape, str(dataset.dtype), params)).encode())
+        key.update(np.ascontiguousarray(dataset).tobytes())
+        return key.hexdigest()
+
     def build_nn(self, bigs2, bigse):
-        dataset = (np.concatenate(
-            [bigs2.reshape(bigs2.shape[0], -1), bigse.reshape(bigse.shape[0], -1)/10], axis=1))
-        nbrs = NearestNeighbors(n_neighbors=1, algorithm='kd_tree', n_jobs=1, leaf_size=10).fit(dataset)
-        return nbrs
+        dataset = self._dataset(bigs2, bigse)
+        if not self.components:
+            return self._cached_index(dataset)
+        mean, basis = self._projection(dataset)
+        return _ReducedIndex(mean, basis, self._cached_index((dataset - mean) @ basis), dataset)
+
+    def _projection(self, dataset):
+        """Mean and the (d, components) basis of principal components of the dataset, cached."""
+        directory = cache_dir('indexes') if self.cache else None
+        path = None
+        if directory is not None:
+            path = os.path.join(directory, 'pca-%s.npz' % self._cache_key(dataset, self.components))
+            try:
+                with np.load(path) as cached:
+                    return cached['mean'], cached['basis']
+            except (OSError, KeyError, ValueError):
+                pass
+
+        mean = dataset.mean(axis=0)
+        _, _, vt = np.linalg.svd(dataset - mean, full_matrices=False)
+        basis = np.ascontiguousarray(vt[:self.components].T).astype(dataset.dtype)
+
+        if path is not None:
+            write_cache(path, lambda tmp: np.savez(tmp, mean=mean, basis=basis))
+        return mean, basis
+
+    def _cached_index(self, dataset):
+        directory = cache_dir('indexes') if self.cache else None
+        if directory is None:
+            return self._build_index(dataset)
+
+        path = os.path.join(directory, '%s-%s' % (self.backend.name,
+                                                  self._cache_key(dataset, sorted(self.index_params().items()))))
+        if os.path.exists(path):
+            try:
+                return self._load_index(path, dataset)
+            except Exception:
+                # Corrupted or incompatible cache entry, rebuild it
+                pass
+
+        index = self._build_index(dataset)
+        write_cache(path, lambda tmp: self._save_index(index, tmp))
+        return index
+
+    def _build_index(self, dataset):
+        return self.backend.build(dataset)
+
+    def _save_index(self, index, path):
+        self.backend.save(index, path)
+
+    def _load_index(self, path, dataset):
+        return self.backend.load(path, dataset)
+
+    @staticmethod
+    def _queries(T, TE):
+        return np.concatenate([T.reshape(len(T), -1), TE.reshape(len(TE), -1)/10], axis=1)
+
+    def search_batch(self, T, TE, nbrs, _bigse):
+        if len(T) == 0:
+            return np.zeros(0, dtype='int'), np.zeros(0)
+        queries = self._queries(T, TE)
+        if not isinstance(nbrs, _ReducedIndex):
+            return self.backend.search(nbrs, queries, self.n_jobs)
+
+        candidates, _ = self.backend.search_knn(nbrs.index, (queries - nbrs.mean) @ nbrs.basis, self.rerank, self.n_jobs)
+        chars = np.empty(len(queries), dtype='int')
+        dists = np.empty(len(queries))
+        step = max(1, self.BATCH_ELEMENTS // (candidates.shape[1] * queries.shape[1]))
+        for start in range(0, len(queries), step):
+            c = candidates[start:start+step]
+            exact = ((nbrs.dataset[c] - queries[start:start+step, np.newaxis])**2).sum(axis=2)
+            # The nearest candidate, the one with the lower index on ties
+            best = np.lexsort((c, exact))[:, 0]
+            chars[start:start+step] = c[np.arange(len(c)), best]
+            dists[start:start+step] = exact[np.arange(len(c)), best]
+        return chars, dists
+
+_ReducedIndex = collections.namedtuple('_ReducedIndex', 'mean basis index dataset')
 
-    def search(self, t, te, nbrs, _bigse):
-        Q = np.array([np.concatenate([t.ravel(), te.ravel()/10])])
-        distances, indices = nbrs.kneighbors(Q)
-        res = indices[0][0], distances[0][0]**2
-        return res
 
 class FastGammaOptimizer(ExactGammaOptimizer):
     """This has the same principle as ExactGammaOptmizer, but an approximate nearest neighbour algorithm is used."""
-    
-    def build_nn(self, bigs2, bigse):
-        try:
-            from n2 import HnswIndex
-        except ModuleNotFoundError:
-            raise ImportError(
-                "n2 is not installed."
-                " To install it as an optional dependency,"
-                " run `pip install 'img2unicode[n2]'`"
-            )
-
-        dataset = (np.concatenate(
-            [bigs2.reshape(bigs2.shape[0], -1), bigse.reshape(bigse.shape[0], -1)/10], axis=1))
-
-        index = HnswIndex(320, "euclidean")
-        for i in dataset:
-            index.add_data(i)
-
-        index.build(m=5)
-        return index
+    BACKEND = 'n2'
 
-    def search(self, t, te, nbrs, _bigse):
-        Q = np.array(np.concatenate([t.ravel(), te.ravel()/10]))
-        res = nbrs.search_by_vector(Q, 1, include_distances=True)[0]
-        return res
 
-try:
-    import n2
-    BestGammaOptimizer = FastGammaOptimizer
-except ImportError:
-    BestGammaOptimizer = ExactGammaOptimizer
+class BestGammaOptimizer(ExactGammaOptimizer):
+    """ExactGammaOptimizer with the backend chosen by a small benchmark on the templates.
+
+    Noisy copies of the templates are searched with every available backend, and the fastest one
+    finding at least MIN_RECALL of the exact nearest templates is used.
+    The choice is saved in the cache directory along with the indexes.
+    """
+    MIN_RECALL = 0.95
+    CALIBRATION_QUERIES = 512
+
+    def choose_backend(self, backend=None):
+        if backend is not None:
+            return super().choose_backend(backend)
+
+        dataset = self._dataset(self.thin_bigs2, self.thin_bigse)
+        candidates = [get_backend(name) for name in available_backends()]
+        directory = cache_dir('indexes') if self.cache else None
+        path = None
+        if directory is not None:
+            params = [(backend.name, sorted(backend.params().items())) for backend in candidates] + [self.MIN_RECALL]
+            path = os.path.join(directory, 'calibration-%s' % self._cache_key(dataset, params))
+            try:
+                with open(path) as f:
+                    return get_backend(f.read().strip())
+            except (OSError, ValueError):
+                pass
+
+        rng = np.random.default_rng(0)
+        queries = dataset[rng.integers(len(dataset), size=self.CALIBRATION_QUERIES)]
+        queries = queries + rng.normal(0, 0.1, queries.shape).astype(queries.dtype)
+        brute = get_backend('brute')
+        _, exact = brute.search(brute.build(dataset), queries)
+
+        timings = {}
+        for backend in candidates:
+            self.backend = backend
+            index = self._cached_index(dataset)
+            start = time.perf_counter()
+            _, distances = backend.search(index, queries, self.n_jobs)
+            elapsed = time.perf_counter() - start
+            # Another template at the same distance is as good
+            recall = np.mean(distances <= exact * (1 + 1e-4) + 1e-6)
+            logging.debug("Gamma backend %s: %.4fs, recall %.3f", backend.name, elapsed, recall)
+            if recall >= self.MIN_RECALL:
+                timings[backend.name] = elapsed
+        best = min(timings, key=timings.get)
+        logging.info("Chose gamma backend %s", best)
+
+        if path is not None:
+            write_cache(path, lambda tmp: _write_text(tmp, best))
+        return get_backend(best)
+
+
+def _write_text(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
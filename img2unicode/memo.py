@@ -0,0 +1,116 @@
+"""Optimizer wrappers memoizing the results for identical cells."""
+import collections
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+
+class MemoizingOptimizer:
+    """Wraps a dual or gamma optimizer and solves every distinct cell content only once.
+
+    The pieces of each cell (see `split_pieces` of the optimizers) are quantized to `levels`
+    values per channel (or taken exactly with levels=None) and hashed. Within an image the identical cells are found with `np.unique`
+    and only the first of them is optimized. The results are also kept in an LRU cache shared
+    by the following images, holding at most about `max_bytes` of entries.
+
+    Screenshots, charts and UI captures with flat backgrounds and repeated glyphs mostly hit the cache.
+    Quantization may map slightly different cells to the same result, use more levels or None to avoid it.
+
+    `hit_ratio` holds the fraction of cells not optimized in the last image.
+    """
+    # Python overhead of a cache entry: dict slot, key bytes object, tuple and numpy scalars
+    ENTRY_OVERHEAD = 400
+
+    def __init__(self, optimizer, levels=256, max_bytes=64 * 2**20):
+        if levels is not None and not 2 <= levels <= 2**16:
+            raise ValueError("levels must be between 2 and 65536")
+        self.optimizer = optimizer
+        self.levels = levels
+        self.max_bytes = max_bytes
+        self.hit_ratio = 0.
+        self._lock = threading.Lock()
+        self.clear()
+
+    @property
+    def n_chars(self):
+        return self.optimizer.n_chars
+
+    @property
+    def use_color(self):
+        return getattr(self.optimizer, 'use_color', True)
+
+    def clear(self):
+        self._cache = collections.OrderedDict()
+        self.cache_bytes = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _keys(self, pieces):
+        """Quantized contents of the cells as rows of bytes."""
+        if self.levels is None:
+            quantized = [np.asarray(p, dtype='float64').reshape(len(p), -1) for p in pieces]
+        else:
+            dtype = 'uint8' if self.levels <= 256 else 'uint16'
+            quantized = [np.round(np.clip(p, 0, 1) * (self.levels - 1)).astype(dtype).reshape(len(p), -1)
+                         for p in pieces]
+        keys = np.ascontiguousarray(np.concatenate(quantized, axis=1))
+        return keys.view(np.dtype((np.void, keys.shape[1] * keys.itemsize))).ravel()
+
+    def _lookup(self, digests):
+        with self._lock:
+            found = []
+            for digest in digests:
+                value = self._cache.get(digest)
+                if value is not None:
+                    self._cache.move_to_end(digest)
+                found.append(value)
+            return found
+
+    def _store(self, digests, values):
+        with self._lock:
+            for digest, value in zip(digests, values):
+                if digest in self._cache:
+                    continue
+                self._cache[digest] = value
+                self.cache_bytes += self._entry_bytes(digest, value)
+            while self.cache_bytes > self.max_bytes and self._cache:
+                digest, value = self._cache.popitem(last=False)
+                self.cache_bytes -= self._entry_bytes(digest, value)
+
+    def _entry_bytes(self, digest, value):
+        return len(digest) + sum(np.asarray(v).nbytes for v in value if v is not None) + self.ENTRY_OVERHEAD
+
+    def optimize_chunk(self, *images):
+        pieces = self.optimizer.split_pieces(*images)
+        if not len(pieces[0]):
+            # Nothing to hash, and a reshape of no cells to rows of keys is ambiguous
+            return self.optimizer.optimize_pieces(*pieces)
+        keys = self._keys(pieces)
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        digests = [hashlib.blake2b(key.tobytes(), digest_size=16).digest() for key in keys[first]]
+
+        values = self._lookup(digests)
+        missing = np.array([value is None for value in values], dtype='bool')
+        if missing.any():
+            results = self.optimizer.optimize_pieces(*[p[first[missing]] for p in pieces])
+            solved = list(zip(*[r if r is not None else [None] * missing.sum() for r in results]))
+            self._store([d for d, m in zip(digests, missing) if m], solved)
+            solved = iter(solved)
+            values = [next(solved) if m else value for value, m in zip(values, missing)]
+
+        self.hit_ratio = 1 - missing.sum() / len(keys)
+        logging.debug("Optimized %d unique of %d cells, %d cached (%.1f%% hits)",
+                      len(first), len(keys), (~missing).sum(), 100 * self.hit_ratio)
+
+        return tuple(np.array(column)[inverse] if column[0] is not None else None
+                     for column in zip(*values))
@@ -1,20 +1,27 @@
+import collections
+import concurrent.futures
 import io
 import logging
+import os
+import queue
+import threading
+import time
 from pathlib import Path
 
 import PIL
 import PIL.Image
+import PIL.ImageSequence
 import numpy as np
+import scipy.ndimage
 import skimage.filters
 import skimage.transform
 import skimage.feature
 import skimage
 
+from img2unicode.ansi import DEFAULT_SENTINEL, AnsiEncoder, DiffEncoder, write_ansi
 from img2unicode.templates import DEFAULT_TEMPLATES
 from img2unicode.utils import uncubify, open_or_pass
 
-DEFAULT_SENTINEL = '\N{LEFT-TO-RIGHT OVERRIDE}' # '\u202D'
-
 def term_fore(fg):
     fore = "\x1b[38;2;{};{};{}m".format(*list(fg))
     return fore
@@ -35,24 +42,105 @@ def float_rgb2term_back(bg):
 def term_reset():
     return "\x1b[0m"
 
+def _optimize_band(renderer, prepared, optimizer, invert, region):
+    # Module-level, so that it can be sent to a process pool
+    return renderer._optimize_prepared(prepared, optimizer, invert, region)
+
+
+def _optimize_chunk(optimizer, images, region):
+    """optimizer.optimize_chunk(*images), telling the region of the frame to the optimizers keeping state per region."""
+    if region is not None and getattr(optimizer, 'keyed_by_region', False):
+        return optimizer.optimize_chunk(*images, region=region)
+    return optimizer.optimize_chunk(*images)
+
+
+def _then(future, pool, fn, submitted=None):
+    """Future of fn(future.result()), run in the pool once the future is done.
+
+    submitted - optional set tracking the futures in the pool until they are done, so that they can be cancelled
+    """
+    result = concurrent.futures.Future()
+
+    def copy(done):
+        if done.cancelled():
+            result.cancel()
+        elif done.exception() is not None:
+            result.set_exception(done.exception())
+        else:
+            result.set_result(done.result())
+
+    def submit(done):
+        try:
+            inner = pool.submit(fn, done.result())
+        except BaseException as e:
+            # Also when the pool was shut down or the future cancelled, because the consumer went away
+            result.set_exception(e)
+            return
+        if submitted is not None:
+            submitted.add(inner)
+            inner.add_done_callback(submitted.discard)
+        inner.add_done_callback(copy)
+
+    future.add_done_callback(submit)
+    return result
+
+
 class Renderer:
-    def __init__(self, default_optimizer=None, max_w=None, max_h=None, allow_upscale=False):
+    """
+    workers - if set, the prepared image is split into bands of whole character rows,
+              which are optimized in parallel by that many workers
+    executor - 'thread' or 'process'; processes avoid the GIL, but need the optimizer to be picklable
+    dtype - float dtype of the prepared images, DTYPE of the class by default;
+            use it together with the optimizer's dtype, e.g. 'float32' for both
+    """
+    DTYPE = 'float32'
+
+    def __init__(self, default_optimizer=None, max_w=None, max_h=None, allow_upscale=False, workers=None,
+            executor='thread', dtype=None):
         self.default_optimizer = default_optimizer
         self.max_w = max_w
         self.max_h = max_h
         self.allow_upscale = allow_upscale
+        self.workers = workers
+        self.executor = executor
+        self.dtype = np.dtype(dtype or self.DTYPE)
 
 
-    def _resize(self, img):
-        w, h = img.size
+    def _target_size(self, size):
+        w, h = size
         ratio = 8 if self.allow_upscale else 1
         if self.max_w is not None:
             ratio = min(ratio, (self.max_w*8) / w)
         if self.max_h is not None:
             ratio = min(ratio, (self.max_h*16) / h)
-        return img.resize((round(w*ratio), round(h*ratio)), PIL.Image.LANCZOS)
+        return round(w*ratio), round(h*ratio)
+
+    # Downscaling keeps at least this many source pixels per target pixel for the final LANCZOS resample,
+    # what is beyond it is shed cheaply: JPEGs are decoded scaled down and other images reduced by box averaging
+    REDUCING_GAP = 2.
+
+    def _resize(self, img, size=None):
+        size = size or self._target_size(img.size)
+        if size == img.size:
+            return img
+        return img.resize(size, PIL.Image.LANCZOS, reducing_gap=self.REDUCING_GAP)
+
+    def _draft(self, img, size):
+        """Let a not yet loaded JPEG decode at the smallest DCT scale still REDUCING_GAP times larger than size."""
+        if size[0] < img.width and size[1] < img.height:
+            # A no-op for other formats and for loaded images
+            img.draft(None, (int(size[0] * self.REDUCING_GAP), int(size[1] * self.REDUCING_GAP)))
 
     def _ensure_image(self, path_or_img):
+        img = self._open_image(path_or_img)
+        size = self._target_size(img.size)
+        if img is not path_or_img:
+            # Opened here, so decoding it scaled down does not alter an image of the caller
+            self._draft(img, size)
+        return self._resize(img, size).convert('RGB')
+
+    @staticmethod
+    def _open_image(path_or_img):
         if isinstance(path_or_img, PIL.Image.Image):
             img = path_or_img
         elif isinstance(path_or_img, (str, Path)):
@@ -63,52 +151,300 @@ class Renderer:
             img = PIL.Image.open(io.BytesIO(path_or_img))
         else:
             raise ValueError("Cannot interpret %s as image" % path_or_img)
+        return img
 
-        return self._resize(img).convert('RGB')
-
-    def _prepare_image(self, img):
-        ims = skimage.img_as_float32(img)
+    def _prepare_image(self, img, optimizer=None):
+        """Filtered float image, the input of `optimizer.optimize_chunk`."""
+        ims = self._as_float(img)
 #         ims = skimage.transform.downscale_local_mean(ims, (downscale, downscale, 1))
         ims = skimage.filters.gaussian(ims, 1, channel_axis=-1)
         ims = ims[:ims.shape[0]-(ims.shape[0]%16), :ims.shape[1]-(ims.shape[1]%8)]
         return ims
 
+    def _as_float(self, img):
+        return skimage.img_as_float32(img) if self.dtype == np.float32 else skimage.img_as_float64(img)
+
+    # Rows of context needed by _prepare_image filters to give the same results on a band as on the whole image
+    BAND_HALO = 16
+
+    def _prepare_band(self, img, top, bottom, optimizer=None):
+        """Prepare rows [top, bottom) of the image, filtering it with BAND_HALO rows of context around."""
+        start = max(0, top - self.BAND_HALO)
+        stop = min(img.height, bottom + self.BAND_HALO)
+        prepared = self._prepare_image(img.crop((0, start, img.width, stop)), optimizer)
+        return self._crop_prepared(prepared, top - start, bottom - start)
+
+    @staticmethod
+    def _crop_prepared(prepared, top, bottom):
+        return prepared[top:bottom]
+
+    @staticmethod
+    def _prepared_height(prepared):
+        return prepared.shape[0]
+
     def optimize(self, path_or_img, optimizer=None, invert=False):
         if optimizer is None:
             optimizer = self.default_optimizer
 
-        img = self._prepare_image(self._ensure_image(path_or_img))
-
-        chars, fgs, bgs = optimizer.optimize_chunk(img)
+        img = self._prepare_image(self._ensure_image(path_or_img), optimizer)
+        if self.workers is not None and self.workers > 1:
+            return self._optimize_parallel(img, optimizer, invert)
+        return self._optimize_prepared(img, optimizer, invert)
+
+    def _optimize_parallel(self, prepared, optimizer, invert=False):
+        """Optimize bands of character rows in a pool and stitch the results.
+
+        The pieces never span rows of cells (gamma pieces overlap only into the next cell
+        to the right), so bands of whole rows give the same results as the whole image.
+        """
+        rows = self._prepared_height(prepared) // 16
+        # A few bands per worker even out the differences in their optimization time
+        bounds = np.linspace(0, rows, min(rows, self.workers * 4) + 1).astype(int) * 16
+        bands = [self._crop_prepared(prepared, top, bottom) for top, bottom in zip(bounds[:-1], bounds[1:])]
+        if len(bands) < 2:
+            return self._optimize_prepared(prepared, optimizer, invert)
+
+        if self.executor == 'process':
+            pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        with pool:
+            # The top row of a band is its region for TemporalOptimizer
+            results = list(pool.map(_optimize_band, [self]*len(bands), bands, [optimizer]*len(bands),
+                                    [invert]*len(bands), bounds[:-1].tolist()))
+
+        # chars and colors are either per-cell arrays in row-major order or 2D grids, both stitch along axis 0
+        img, chars, fgs, bgs = zip(*results)
+        return (np.concatenate(img), np.concatenate(chars),
+                np.concatenate(fgs) if fgs[0] is not None else None,
+                np.concatenate(bgs) if bgs[0] is not None else None)
+
+    def _optimize_prepared(self, img, optimizer, invert=False, region=None):
+        chars, fgs, bgs = _optimize_chunk(optimizer, (img,), region)
         return img, chars, fgs, bgs
 
     @staticmethod
-    def print_to_terminal(file, chars, fgs, bgs, sentinel=DEFAULT_SENTINEL):
-        with open_or_pass(file, 'w') as f:
-            for y in range(chars.shape[0]):
-                for x in range(chars.shape[1]):
-                    idx = y, x
-                    res = chars[idx]
-
-                    if fgs is not None:
-                        fore = term_fore(fgs[idx])
-                    else:
-                        fore = ''
-                    if bgs is not None:
-                        back = term_back(bgs[idx])
-                    else:
-                        back = ''
-                    # Add LTR override to fix Arabic script (\u202D)
-                    prefix = sentinel
-                    f.write(prefix + fore + back + chr(res))
-                f.write(term_reset() + '\n')
-
-    def render_terminal(self, path_or_img, file, optimizer=None, sentinel=DEFAULT_SENTINEL, **kwargs):
+    def print_to_terminal(file, chars, fgs, bgs, sentinel=DEFAULT_SENTINEL, skip_repeated=False, tolerance=0,
+                          palette=None, encoder=None):
+        """Write the frame to file. Returns the number of bytes saved by skipping repeated color escapes.
+
+        palette - None for 24-bit colors, '256' or '16' to quantize colors for less capable terminals.
+        encoder - AnsiEncoder to use instead of the one configured by the arguments above,
+                  e.g. DiffEncoder reused between frames of a frame loop.
+        """
+        if encoder is None:
+            # Add LTR override to fix Arabic script (\u202D) before each cell
+            encoder = AnsiEncoder(sentinel, skip_repeated=skip_repeated, tolerance=tolerance, palette=palette)
+        saved_before = encoder.bytes_saved
+        data = encoder.encode(chars, fgs, bgs)
+        with open_or_pass(file, 'wb') as f:
+            write_ansi(f, data)
+        saved = encoder.bytes_saved - saved_before
+        if encoder.skip_repeated:
+            logging.debug("Wrote %d bytes, saved %d bytes (%.1f%%) of color escapes",
+                          len(data), saved, 100 * saved / max(1, len(data) + saved))
+        return saved
+
+    def render_terminal(self, path_or_img, file, optimizer=None, sentinel=DEFAULT_SENTINEL, skip_repeated=False,
+                        tolerance=0, palette=None, encoder=None, **kwargs):
         chars, fgs, bgs = self.render_numpy(path_or_img, optimizer, **kwargs)
-        self.print_to_terminal(file, chars, fgs, bgs, sentinel=sentinel)
+        return self.print_to_terminal(file, chars, fgs, bgs, sentinel=sentinel, skip_repeated=skip_repeated,
+                                      tolerance=tolerance, palette=palette, encoder=encoder)
+
+    def render_many(self, paths_or_imgs, optimizer=None, ordered=True, encoder=None, io_workers=4,
+                    compute_workers=None, max_pending=16, **kwargs):
+        """Render many images in a pipeline, yielding (index, encoded frame) pairs.
+
+        Images are decoded and resized in a pool of `io_workers` threads, prepared and optimized
+        in a pool of `compute_workers` threads (all cores by default) and encoded by a single
+        writer thread using `encoder` (a plain AnsiEncoder by default), so the stages overlap.
+        At most `max_pending` images are in flight, which bounds the memory use.
+
+        ordered - yield in the input order; otherwise as soon as each image is done
+        """
+        if optimizer is None:
+            optimizer = self.default_optimizer
+        if encoder is None:
+            encoder = AnsiEncoder()
+
+        def compute(img):
+            return self._to_numpy(*self._optimize_prepared(self._prepare_image(img, optimizer), optimizer, **kwargs))
+
+        def encode(frame):
+            return encoder.encode(*frame)
+
+        io_pool = concurrent.futures.ThreadPoolExecutor(io_workers)
+        compute_pool = concurrent.futures.ThreadPoolExecutor(compute_workers or os.cpu_count() or 1)
+        writer_pool = concurrent.futures.ThreadPoolExecutor(1)
+        pending = collections.deque()
+        # Futures queued or running in the pools
+        submitted = set()
+        try:
+            items = iter(enumerate(paths_or_imgs))
+            exhausted = False
+            while pending or not exhausted:
+                while not exhausted and len(pending) < max_pending:
+                    try:
+                        index, item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    loaded = io_pool.submit(self._ensure_image, item)
+                    submitted.add(loaded)
+                    loaded.add_done_callback(submitted.discard)
+                    computed = _then(loaded, compute_pool, compute, submitted)
+                    pending.append((index, _then(computed, writer_pool, encode, submitted)))
+
+                if not pending:
+                    break
+                if ordered:
+                    index, future = pending.popleft()
+                    yield index, future.result()
+                else:
+                    concurrent.futures.wait([f for _, f in pending], return_when=concurrent.futures.FIRST_COMPLETED)
+                    for entry in [entry for entry in pending if entry[1].done()]:
+                        pending.remove(entry)
+                        yield entry[0], entry[1].result()
+        finally:
+            # On an early exit, do not leave the queued images to be decoded and optimized in the background.
+            # The pools accept no more work after shutdown, so no future is added to submitted meanwhile.
+            for pool in (io_pool, compute_pool, writer_pool):
+                pool.shutdown(wait=False)
+            while submitted:
+                try:
+                    # pop is atomic, unlike iteration while pool threads discard the finished futures
+                    submitted.pop().cancel()
+                except KeyError:
+                    break
+
+    def render_animation(self, path_or_img, file, optimizer=None, encoder=None, loop=False, prefetch=4,
+                         default_duration=100, clear=True, **kwargs):
+        """Play an animated image (e.g. GIF) in the terminal at its frame rate.
+
+        All frames are resized to the geometry of the first one. They are decoded and optimized
+        in a background thread up to `prefetch` frames ahead, and the output is encoded with
+        `encoder`, by default a DiffEncoder, so only the changed cells are redrawn.
+        When rendering falls behind, frames whose time has already passed are dropped
+        instead of stalling the playback.
+
+        default_duration - frame duration in ms for frames that do not specify it
+        clear - clear the screen first and hide the cursor during the playback (needed by DiffEncoder)
+        Returns numbers of shown and dropped frames.
+        """
+        if optimizer is None:
+            optimizer = self.default_optimizer
+        if encoder is None:
+            encoder = DiffEncoder()
+
+        img = self._open_image(path_or_img)
+        size = self._target_size(img.size)
+        frames = queue.Queue(prefetch)
+        stop = threading.Event()
+        # Playback clock starts when the first frame is shown
+        clock = {}
+
+        def elapsed():
+            return time.monotonic() - clock['start'] if 'start' in clock else 0.
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce():
+            try:
+                slot = 0.
+                while not stop.is_set():
+                    for frame in PIL.ImageSequence.Iterator(img):
+                        if stop.is_set():
+                            return
+                        slot_end = slot + (frame.info.get('duration') or default_duration) / 1000
+                        triple = None
+                        if elapsed() < slot_end:
+                            frame = self._resize(frame.convert('RGB'), size)
+                            triple = self._to_numpy(*self._optimize_prepared(self._prepare_image(frame, optimizer),
+                                                                             optimizer, **kwargs))
+                        put((slot, slot_end, triple))
+                        slot = slot_end
+                    if not loop:
+                        break
+            except BaseException as e:
+                put(e)
+            put(None)
+
+        threading.Thread(target=produce, daemon=True).start()
+        shown = dropped = 0
+        with open_or_pass(file, 'wb') as f:
+            if clear:
+                write_ansi(f, b'\x1b[2J\x1b[?25l')
+            try:
+                while True:
+                    item = frames.get()
+                    if item is None:
+                        break
+                    if isinstance(item, BaseException):
+                        raise item
+                    slot, slot_end, triple = item
+                    if triple is None:
+                        dropped += 1
+                        continue
+                    if 'start' not in clock:
+                        clock['start'] = time.monotonic() - slot
+                    now = elapsed()
+                    if now >= slot_end:
+                        dropped += 1
+                        continue
+                    if slot > now:
+                        time.sleep(slot - now)
+                    write_ansi(f, encoder.encode(*triple))
+                    f.flush()
+                    shown += 1
+            finally:
+                stop.set()
+                if clear:
+                    # Put the cursor below the last frame
+                    rows = 0
+                    if getattr(encoder, 'previous', None) is not None:
+                        rows = encoder.origin[0] + encoder.previous[0].shape[0]
+                    write_ansi(f, ('\x1b[%d;1H\x1b[?25h' % (rows + 1)).encode())
+                    f.flush()
+        logging.debug("Shown %d frames, dropped %d", shown, dropped)
+        return shown, dropped
+
+    def render_stream(self, path_or_img, optimizer=None, band_rows=1, encoder=None, sentinel=DEFAULT_SENTINEL,
+                      **kwargs):
+        """Render the image band by band, yielding encoded terminal lines of each band as soon as it is done.
+
+        band_rows - number of character rows (16 pixel rows each) processed at once
+        encoder - AnsiEncoder to use, by default one with `sentinel` and no extra options
+
+        Only the current band (with the context the filters need) is converted to float
+        and optimized, so the memory use is bounded by the band size, not the image size.
+        """
+        if encoder is None:
+            encoder = AnsiEncoder(sentinel)
+        for chars, fgs, bgs in self.render_numpy_stream(path_or_img, optimizer, band_rows, **kwargs):
+            yield encoder.encode(chars, fgs, bgs)
+
+    def render_numpy_stream(self, path_or_img, optimizer=None, band_rows=1, **kwargs):
+        """Like `render_numpy`, but yields (chars, fgs, bgs) of consecutive bands of `band_rows` character rows."""
+        if optimizer is None:
+            optimizer = self.default_optimizer
+
+        img = self._ensure_image(path_or_img)
+        height = img.height - img.height % 16
+        for top in range(0, height, 16*band_rows):
+            prepared = self._prepare_band(img, top, min(top + 16*band_rows, height), optimizer)
+            yield self._to_numpy(*self._optimize_prepared(prepared, optimizer, region=top, **kwargs))
 
     def render_numpy(self, path_or_img, optimizer=None, **kwargs):
-        img, chars, fgs, bgs = self.optimize(path_or_img, optimizer, **kwargs)
+        return self._to_numpy(*self.optimize(path_or_img, optimizer, **kwargs))
+
+    @staticmethod
+    def _to_numpy(img, chars, fgs, bgs):
         if fgs is not None:
             fgs = (255*fgs).astype('uint8')
         if bgs is not None:
@@ -141,7 +477,7 @@ class Renderer:
         if recov.shape[-1] == 1:
             # no colors used?
             recov = np.tile(recov, (1, 1, 3))
-        recov_img = uncubify(recov.reshape(-1, 16, 8, 3), img.shape).clip(0., 1.)
+        recov_img = uncubify(recov.reshape(-1, 16, 8, 3), img.shape[:2] + (3,)).clip(0., 1.)
 
         if show:
             import matplotlib.pyplot as plt
@@ -152,43 +488,101 @@ class Renderer:
 
         return PIL.Image.fromarray(skimage.img_as_ubyte(recov_img))
 
-class GammaRenderer(Renderer):
-    def _prepare_image(self, img):
-
-        imgl = skimage.img_as_float(img.convert('L'))
-        imgl = skimage.filters.unsharp_mask(imgl, 3)
-#         if downscale not in (0, 1):
-#             imgl = skimage.transform.downscale_local_mean(imgl, (downscale,downscale))
+def _scratch(name, shape, dtype):
+    """A per-thread buffer reused by the following calls with the same shape, for intermediate results only."""
+    buffers = _SCRATCH.__dict__
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = buffers[name] = np.empty(shape, dtype=dtype)
+    return buffer
 
-        img_gray = skimage.filters.gaussian(imgl, 1, channel_axis=None)
-#         img_gray = skimage.exposure.adjust_sigmoid(img_gray)
-        img_edges = skimage.feature.canny(skimage.transform.downscale_local_mean(imgl, (2,2)), 1).astype('float')
-        img_gray = img_gray[:img_gray.shape[0]-(img_gray.shape[0]%16), :img_gray.shape[1]-(img_gray.shape[1]%8)]
+_SCRATCH = threading.local()
 
 
-        imgc = skimage.img_as_float(img.convert('RGB'))
-#         if downscale not in (0, 1):
-#             imgc = skimage.transform.downscale_local_mean(imgc, (downscale,downscale,1))
-        imgc = skimage.filters.gaussian(imgc, 1, channel_axis=-1)
-        imgc = imgc[:imgc.shape[0]-(imgc.shape[0]%16), :imgc.shape[1]-(imgc.shape[1]%8)]
+class GammaRenderer(Renderer):
+    DTYPE = 'float32'
+
+    def _prepare_image(self, img, optimizer=None):
+        """Sharpened and blurred gray image, its edges at half resolution and blurred colors.
+
+        The colors are None when `optimizer` has use_color=False, as it never reads them.
+        The image is cropped to whole cells before filtering. The sharpened gray image is shared
+        by the gray and edge paths, and the intermediate arrays live in per-thread scratch buffers.
+        Durations of the steps of the last call are kept in `prepare_timings`.
+        """
+        timings = {}
+        clock = [time.perf_counter()]
+
+        def lap(step):
+            now = time.perf_counter()
+            timings[step] = now - clock[0]
+            clock[0] = now
+
+        img = img.crop((0, 0, img.width - img.width % 8, img.height - img.height % 16))
+        gray = np.asarray(img.convert('L'))
+        use_color = getattr(optimizer, 'use_color', True)
+        rgb = np.asarray(img.convert('RGB')) if use_color else None
+        lap('convert')
+
+        # unsharp_mask(imgl, 3): imgl + (imgl - gaussian(imgl, 3)), clipped to [0, 1]
+        imgl = _scratch('gray', gray.shape, self.dtype)
+        np.multiply(gray, 1 / 255, out=imgl, casting='unsafe')
+        blurred = _scratch('blurred', gray.shape, self.dtype)
+        scipy.ndimage.gaussian_filter(imgl, 3, output=blurred, mode='reflect')
+        np.subtract(imgl, blurred, out=blurred)
+        imgl += blurred
+        np.clip(imgl, 0, 1, out=imgl)
+        lap('unsharp')
+
+        img_gray = scipy.ndimage.gaussian_filter(imgl, 1, output=np.empty_like(imgl), mode='nearest')
+        lap('gray')
+
+        # downscale_local_mean(imgl, (2, 2)), the dimensions are even after the crop
+        half = _scratch('half', (gray.shape[0] // 2, gray.shape[1] // 2), self.dtype)
+        np.add(imgl[0::2, 0::2], imgl[0::2, 1::2], out=half)
+        half += imgl[1::2, 0::2]
+        half += imgl[1::2, 1::2]
+        half *= 0.25
+        img_edges = skimage.feature.canny(half, 1).astype(self.dtype)
+        lap('edges')
+
+        imgc = None
+        if use_color:
+            imgc = _scratch('color', rgb.shape, self.dtype)
+            np.multiply(rgb, 1 / 255, out=imgc, casting='unsafe')
+            imgc = scipy.ndimage.gaussian_filter(imgc, (1, 1, 0), output=np.empty_like(imgc), mode='nearest')
+            lap('color')
+
+        self.prepare_timings = timings
+        logging.debug("Prepared %dx%d image: %s", img.width, img.height,
+                      ', '.join('%s %.1fms' % (step, 1000 * t) for step, t in timings.items()))
+        return img_gray, img_edges, imgc
 
+    # unsharp_mask (sigma 3) followed by gaussian (sigma 1) needs 16 rows, canny hysteresis gets some more
+    BAND_HALO = 32
 
-        return img_gray, img_edges, imgc
+    @staticmethod
+    def _crop_prepared(prepared, top, bottom):
+        img_gray, img_edges, imgc = prepared
+        return img_gray[top:bottom], img_edges[top//2:bottom//2], imgc[top:bottom] if imgc is not None else None
 
-    def optimize(self, path_or_img, optimizer=None, invert=False):
-        if optimizer is None:
-            optimizer = self.default_optimizer
+    @staticmethod
+    def _prepared_height(prepared):
+        return prepared[0].shape[0]
 
-        img_gray, img_edges, imgc = self._prepare_image(self._ensure_image(path_or_img))
+    def _optimize_prepared(self, prepared, optimizer, invert=False, region=None):
+        img_gray, img_edges, imgc = prepared
         if invert:
             img_gray = 1-img_gray
             img_edges = img_edges
-            imgc = 1-imgc
+            if imgc is not None:
+                imgc = 1-imgc
 
-        chars, fgs, bgs = optimizer.optimize_chunk(img_gray, img_edges, imgc)
+        chars, fgs, bgs = _optimize_chunk(optimizer, (img_gray, img_edges, imgc), region)
         if invert:
             if fgs is not None:
                 fgs = 1 - fgs
             if bgs is not None:
                 bgs = 1 - bgs
-        return imgc[:,:-8], chars, fgs, bgs
+        # Without colors, the gray image gives the geometry
+        return (imgc if imgc is not None else img_gray)[:,:-8], chars, fgs, bgs
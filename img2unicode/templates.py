@@ -1,7 +1,14 @@
+import hashlib
+import logging
+import re
+
 import numpy as np
 import os
+import threading
 import typing
 
+from img2unicode.utils import cache_dir, write_cache
+
 
 class Templates:
     def __init__(self, base_16x16, edges_8x8=None, default_mask=None,
@@ -15,6 +22,8 @@ class Templates:
         self.default_mask = default_mask if default_mask is not None else np.ones(
             len(base_16x16), dtype='bool')
         self.indexer = np.arange(len(base_16x16))
+        # Directory the templates were memory-mapped from (see save(mmap=True)), also holds derived arrays
+        self.store = None
 
     @property
     def n_chars(self):
@@ -34,16 +43,78 @@ class Templates:
     def edges_8x4(self):
         raise NotImplementedError("TODO compute edges")
 
-    @staticmethod
-    def from_file(prefix):
-        return Templates(**np.load(prefix + '.npz'))
+    ARRAYS = ('base_16x16', 'edges_8x8', 'default_mask', 'raw_16x16')
 
-    def save(self, prefix):
-        np.savez_compressed(prefix + '.npz',
-                            base_16x16=self.base_16x16,
-                            edges_8x8=self.edges_8x8,
-                            default_mask=self.default_mask,
-                            raw_16x16=self.raw_16x16)
+    @staticmethod
+    def from_file(prefix, cache=False, mmap_mode='r'):
+        """Load templates from prefix.npz, or from prefix directory saved with `save(prefix, mmap=True)`.
+
+        Arrays from a directory are opened with `mmap_mode`, so processes using the same
+        store share the memory through the OS page cache.
+        With cache=True such a store is created from the .npz file in the cache directory
+        (see `utils.cache_dir`) and used by the next processes.
+        """
+        if os.path.isdir(prefix):
+            arrays = {}
+            for name in Templates.ARRAYS:
+                path = os.path.join(prefix, name + '.npy')
+                if os.path.exists(path):
+                    arrays[name] = np.load(path, mmap_mode=mmap_mode)
+            templates = Templates(**arrays)
+            templates.store = prefix
+            return templates
+
+        path = prefix + '.npz'
+        cached = _store_path(path) if cache else None
+        if cached is not None and os.path.isdir(cached):
+            return Templates.from_file(cached, mmap_mode=mmap_mode)
+
+        templates = Templates(**np.load(path))
+        if cached is not None:
+            logging.info("Caching templates %s in %s", path, cached)
+            # Stores of the previous versions of the file are not needed anymore
+            write_cache(cached, lambda tmp: templates.save(tmp, mmap=True), _stale_stores(cached))
+            if os.path.isdir(cached):
+                return Templates.from_file(cached, mmap_mode=mmap_mode)
+        return templates
+
+    def save(self, prefix, compressed=True, mmap=False):
+        """Save templates to prefix.npz.
+
+        mmap - save each array as a separate uncompressed, aligned .npy file in prefix directory instead,
+               for loading with memory mapping.
+        """
+        arrays = dict(base_16x16=self.base_16x16,
+                      edges_8x8=self.edges_8x8,
+                      default_mask=self.default_mask)
+        if self.raw_16x16 is not None:
+            arrays['raw_16x16'] = self.raw_16x16
+        if mmap:
+            os.makedirs(prefix, exist_ok=True)
+            for name, arr in arrays.items():
+                np.save(os.path.join(prefix, name + '.npy'), arr)
+        else:
+            (np.savez_compressed if compressed else np.savez)(prefix + '.npz', **arrays)
+
+    def derived(self, name, mask, compute):
+        """Get an array derived from the templates for the given char mask.
+
+        If the templates come from a store directory, the array is saved there once
+        and memory-mapped afterwards, so it is shared between processes as well.
+        """
+        if self.store is None:
+            return compute()
+        digest = hashlib.sha1(np.packbits(np.asarray(mask, dtype='bool')).tobytes()).hexdigest()[:16]
+        path = os.path.join(self.store, 'derived', '%s-%s.npy' % (name, digest))
+        if not os.path.exists(path):
+            arr = compute()
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            except OSError:
+                return arr
+            if not write_cache(path, lambda tmp: np.save(tmp, arr)):
+                return arr
+        return np.load(path, mmap_mode='r')
 
     def common_masks(self):
         ascii = self.default_mask.copy()
@@ -77,7 +148,55 @@ class Templates:
         }
 
 
-DEFAULT_TEMPLATES = Templates.from_file(
+def _store_path(path):
+    directory = cache_dir('templates')
+    if directory is None:
+        return None
+    stat = os.stat(path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(directory, '%s-%d-%d' % (name, stat.st_size, stat.st_mtime_ns))
+
+
+def _stale_stores(store):
+    """Other stores of the same templates file, made from its previous versions."""
+    directory, current = os.path.split(store)
+    pattern = re.compile(re.escape(current.rsplit('-', 2)[0]) + r'-\d+-\d+')
+    return [os.path.join(directory, entry) for entry in os.listdir(directory)
+            if entry != current and pattern.fullmatch(entry)]
+
+
+class LazyTemplates(Templates):
+    """Templates loaded from file on the first access to any of their attributes.
+
+    Importing the package does not pay for decompressing the templates,
+    which is significant for short-lived processes and optimizers that do not use them.
+    Copies and pickles refer to the same file and load it on their own.
+    """
+    # Attributes of the proxy itself, missing only before __init__ ran (e.g. while copying or unpickling)
+    _OWN = ('_prefix', '_cache', '_templates', '_lock')
+    def __init__(self, prefix, cache=True):
+        self._prefix = prefix
+        self._cache = cache
+        self._templates = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._templates is None:
+            with self._lock:
+                if self._templates is None:
+                    self._templates = Templates.from_file(self._prefix, cache=self._cache)
+        return self._templates
+
+    def __getattr__(self, name):
+        if name in self._OWN or name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __reduce__(self):
+        return LazyTemplates, (self._prefix, self._cache)
+
+
+DEFAULT_TEMPLATES = LazyTemplates(
     os.path.join(os.path.dirname(__file__), 'Ubuntu Mono'))
 
 
@@ -101,10 +220,10 @@ def get_16x8_flat(templates=None, mask=None):
     base = templates.base_16x8
     premask = templates.default_mask
 
-    cs_all = base.reshape(base.shape[0], -1).clip(0, 1)
     mask = normalize_mask(mask, premask, templates) & premask
+    cs = templates.derived('16x8_flat', mask, lambda: base.reshape(base.shape[0], -1).clip(0, 1)[mask])
 
-    return cs_all[mask], templates.indexer[mask]
+    return cs, templates.indexer[mask]
 
 
 def get_16x16(templates=None, mask=None, return_edges=True):
@@ -115,7 +234,8 @@ def get_16x16(templates=None, mask=None, return_edges=True):
     premask = templates.default_mask
     mask = normalize_mask(mask, premask, templates) & premask
 
+    masked_base = templates.derived('16x16', mask, lambda: base[mask])
     if return_edges:
-        return base[mask], edges[mask], templates.indexer[mask]
+        return masked_base, templates.derived('edges_8x8', mask, lambda: edges[mask]), templates.indexer[mask]
     else:
-        return base[mask], templates.indexer[mask]
+        return masked_base, templates.indexer[mask]
@@ -0,0 +1,110 @@
+"""Optimizer wrappers reusing work between frames of a video-like input."""
+import logging
+import threading
+
+import numpy as np
+
+
+class _RegionState:
+    """Pieces and results of the last computation for a region of the frame."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pieces = None
+        self.results = None
+
+
+class TemporalOptimizer:
+    """Wraps a dual or gamma optimizer and reuses the previous decisions for cells that barely changed.
+
+    Each piece of the frame (see `split_pieces` of the optimizers) is compared with the piece
+    the cell's current result was computed from. Only the cells whose distance exceeds
+    `threshold` are passed to the wrapped optimizer, for the rest char, fg and bg are copied forward.
+    Comparing with the piece of the last computation rather than of the previous frame
+    prevents slow changes from accumulating unnoticed.
+
+    The state is kept separately for each `region` passed to `optimize_chunk`, a hashable key of
+    the part of the frame the images cover. Renderers pass the top row of each band when they optimize
+    a frame band by band, so a band is compared with the same band of the previous frame.
+    Different regions may be optimized concurrently.
+
+    threshold - per-pixel distance on the 0-1 scale
+    metric - 'l1' for mean absolute difference, 'l2' for root mean square difference
+
+    `reuse_ratio` holds the fraction of cells reused in the last call.
+    """
+    # Renderers pass the region to optimize_chunk
+    keyed_by_region = True
+
+    def __init__(self, optimizer, threshold=0.02, metric='l1'):
+        if metric not in ('l1', 'l2'):
+            raise ValueError("Unknown metric %s" % metric)
+        self.optimizer = optimizer
+        self.threshold = threshold
+        self.metric = metric
+        self.reuse_ratio = 0.
+        self._lock = threading.Lock()
+        self.reset()
+
+    @property
+    def n_chars(self):
+        return self.optimizer.n_chars
+
+    @property
+    def use_color(self):
+        return getattr(self.optimizer, 'use_color', True)
+
+    def reset(self):
+        """Forget the previous frame, e.g. on a scene cut."""
+        with self._lock:
+            self._states = {}
+
+    def __getstate__(self):
+        # The previous frame stays with this instance, e.g. when sent to a process pool
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_states'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _state(self, region):
+        with self._lock:
+            return self._states.setdefault(region, _RegionState())
+
+    def _distance(self, a, b):
+        diff = (a - b).reshape(len(a), -1)
+        if self.metric == 'l1':
+            return np.abs(diff).mean(axis=1)
+        return np.sqrt((diff**2).mean(axis=1))
+
+    def _changed(self, state, pieces):
+        if state.pieces is None or [p.shape for p in pieces] != [p.shape for p in state.pieces]:
+            return np.ones(len(pieces[0]), dtype='bool')
+        changed = np.zeros(len(pieces[0]), dtype='bool')
+        for new, old in zip(pieces, state.pieces):
+            changed |= self._distance(new, old) > self.threshold
+        return changed
+
+    def optimize_chunk(self, *images, region=None):
+        pieces = self.optimizer.split_pieces(*images)
+        state = self._state(region)
+        with state.lock:
+            changed = self._changed(state, pieces)
+
+            if changed.all():
+                state.pieces = [p.copy() for p in pieces]
+                state.results = list(self.optimizer.optimize_pieces(*pieces))
+            elif changed.any():
+                results = self.optimizer.optimize_pieces(*[p[changed] for p in pieces])
+                for old, new in zip(state.pieces, pieces):
+                    old[changed] = new[changed]
+                for old, new in zip(state.results, results):
+                    if old is not None:
+                        old[changed] = new
+            results = tuple(r.copy() if r is not None else None for r in state.results)
+
+        self.reuse_ratio = 1 - changed.mean() if len(changed) else 0.
+        logging.debug("Reused %d of %d cells (%.1f%%)", (~changed).sum(), len(changed), 100 * self.reuse_ratio)
+        return results
@@ -1,3 +1,6 @@
+import os
+import shutil
+import threading
 from contextlib import contextmanager
 from pathlib import Path
 
@@ -20,6 +23,73 @@ def uncubify(arr, oldshape):
     order = np.arange(len(tmpshape)).reshape(2, -1).ravel(order='F')
     return arr.reshape(tmpshape).transpose(order).reshape(oldshape)
 
+def as_dtype(arr, dtype):
+    """Cast arr to dtype, without copying if it already has it. dtype=None keeps arr as is."""
+    if dtype is None or arr is None:
+        return arr
+    return np.asarray(arr, dtype=dtype)
+
+def masked_median(values, masks):
+    """Medians of values (B, n, c) over the elements selected by each of the disjoint masks (B, n).
+
+    The values are sorted once, and then stably grouped by the mask selecting them (a radix sort of small labels),
+    so each median is picked by position, without NaN-filled copies. Returns (B, c) arrays,
+    NaN where a mask selects nothing, equal to `np.nanmedian` of the masked values.
+    """
+    B, n, c = values.shape
+    labels = np.full((B, n), len(masks), dtype='uint8')
+    for i, mask in reversed(list(enumerate(masks))):
+        labels[mask] = i
+    values = np.swapaxes(values, 1, 2)
+    order = np.argsort(values, axis=2)
+    sorted_values = np.take_along_axis(values, order, axis=2)
+    sorted_labels = np.take_along_axis(np.broadcast_to(labels[:, np.newaxis], values.shape), order, axis=2)
+    grouped = np.take_along_axis(sorted_values, np.argsort(sorted_labels, axis=2, kind='stable'), axis=2)
+
+    medians = []
+    start = np.zeros(B, dtype='int')
+    for mask in masks:
+        count = mask.sum(axis=1)
+        low = np.minimum(start + np.maximum(count - 1, 0) // 2, n - 1)
+        high = np.minimum(start + count // 2, n - 1)
+        low = np.take_along_axis(grouped, np.broadcast_to(low[:, np.newaxis, np.newaxis], (B, c, 1)), axis=2)[:, :, 0]
+        high = np.take_along_axis(grouped, np.broadcast_to(high[:, np.newaxis, np.newaxis], (B, c, 1)), axis=2)[:, :, 0]
+        # Halves are exact, so this rounds like (low + high) / 2, and does not overflow integers
+        medians.append(np.where(count[:, np.newaxis] > 0, low / 2 + high / 2, np.nan))
+        start += count
+    return medians
+
+def masked_histogram_median(values, masks, bins=256):
+    """Approximate `masked_median` from per-block histograms of the disjoint masks, without sorting.
+
+    Integer values (e.g. uint8 pixels) are counted as they are, which makes the result exact for them,
+    values in [0, 1] are quantized to `bins` levels first. Fewer bins are faster and coarser.
+    """
+    B, n, c = values.shape
+    integer = np.issubdtype(values.dtype, np.integer)
+    if integer:
+        bins = max(bins, int(values.max(initial=0)) + 1)
+        levels = values.astype(np.intp)
+    else:
+        levels = np.clip(np.rint(values * (bins - 1)), 0, bins - 1).astype(np.intp)
+    labels = np.full((B, n), len(masks), dtype=np.intp)
+    for i, mask in reversed(list(enumerate(masks))):
+        labels[mask] = i
+    # One histogram per (label, block, channel), all counted at once
+    index = ((labels[:, :, np.newaxis] * B + np.arange(B)[:, np.newaxis, np.newaxis]) * c + np.arange(c)) * bins + levels
+    hist = np.bincount(index.ravel(), minlength=(len(masks) + 1) * B * c * bins)
+    ranks = hist.reshape(len(masks) + 1, B, c, bins)[:-1].cumsum(axis=3)
+
+    medians = []
+    for mask_ranks in ranks:
+        count = mask_ranks[:, :, -1:]
+        # The bin holding the element of a rank is the number of bins with lower ranks only
+        median = ((mask_ranks <= (count - 1) // 2).sum(axis=2) + (mask_ranks <= count // 2).sum(axis=2)) / 2
+        if not integer:
+            median = (median / (bins - 1)).astype(values.dtype)
+        medians.append(np.where(count[:, :, 0] > 0, median, np.nan))
+    return medians
+
 @contextmanager
 def open_or_pass(filename_or_fobj, *args, **kwargs):
     if isinstance(filename_or_fobj, (str, Path)):
@@ -27,3 +97,54 @@ def open_or_pass(filename_or_fobj, *args, **kwargs):
             yield f
     else:
         yield filename_or_fobj
+
+
+def cache_dir(*parts):
+    """Get (and create) a directory for on-disk caches, or None if caching is disabled.
+
+    The cache lives in $IMG2UNICODE_CACHE if set (set it empty to disable caching),
+    otherwise in $XDG_CACHE_HOME/img2unicode, i.e. ~/.cache/img2unicode by default.
+    """
+    base = os.environ.get('IMG2UNICODE_CACHE')
+    if base is None:
+        base = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                            'img2unicode')
+    if not base:
+        return None
+    path = os.path.join(base, *parts)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return None
+    return path
+
+
+def write_cache(path, write, stale=()):
+    """Write a cache entry, a file or a directory, by calling write(tmp) and moving tmp to path.
+
+    Concurrent writers never expose a partial entry, the last one to finish wins.
+    Once the entry is in place, the paths in `stale` (e.g. entries it supersedes) are removed.
+    Caching is optional, so errors are swallowed: returns whether the entry was written.
+    """
+    root, ext = os.path.splitext(path)
+    # Keep the extension, as numpy appends it otherwise
+    tmp = '%s.%d-%d%s' % (root, os.getpid(), threading.get_ident(), ext)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except OSError:
+        _remove(tmp)
+        return False
+    for old in stale:
+        _remove(old)
+    return True
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -21,6 +21,7 @@ setup(name='img2unicode',
         'numpy>=1.19',
         'pandas',
         'scikit-image>=0.19,<1.0',
+        'scipy', # Image filters of GammaRenderer
         'pillow',
         'scikit-learn', # For ExactGammaRenderer
         'click', # UI
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pytest
+import scipy.ndimage
+
+import img2unicode
+from img2unicode.templates import Templates
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), os.pardir, 'examples', 'obama.jpg')
+
+# Fraction of cells whose char may differ between float32 and the default dtypes
+MAX_CHANGED = 0.02
+
+
+@pytest.fixture(scope='module')
+def templates():
+    """Glyph-like templates: blobs of smoothed noise, a quarter of them spanning both halves of the 16x16 cell.
+
+    The bundled Ubuntu Mono templates are stored in Git LFS and may be missing from a checkout.
+    """
+    rng = np.random.default_rng(0)
+    n = 256
+    noise = scipy.ndimage.gaussian_filter(rng.random((n, 16, 16)), (0, 1.5, 1.5))
+    base = (noise > np.median(noise, axis=(1, 2), keepdims=True)).astype('float64')
+    base[n//4:, :, 8:] = 0
+    edges = (base.reshape(n, 8, 2, 8, 2).std(axis=(2, 4)) > 0).astype('float64')
+    return Templates(base, edges_8x8=edges, raw_16x16=base.copy())
+
+
+def changed(renderer_cls, make_optimizer):
+    """Fraction of chars changed by rendering EXAMPLE in float32 instead of the default dtypes."""
+    reference = renderer_cls(make_optimizer(None), max_w=40, max_h=20, dtype='float64').render_numpy(EXAMPLE)
+    result = renderer_cls(make_optimizer('float32'), max_w=40, max_h=20, dtype='float32').render_numpy(EXAMPLE)
+    assert result[0].shape == reference[0].shape
+    return (result[0] != reference[0]).mean()
+
+
+@pytest.mark.parametrize('optimizer', [
+    'FastGenericDualOptimizer',
+    'ExactGenericDualOptimizer',
+    'FastQuadDualOptimizer',
+])
+def test_dual_float32(optimizer, templates):
+    cls = getattr(img2unicode, optimizer)
+    assert changed(img2unicode.Renderer, lambda dtype: cls(None, templates, dtype=dtype)) <= MAX_CHANGED
+
+
+@pytest.mark.parametrize('use_color', [True, False])
+def test_gamma_float32(use_color, templates):
+    make = lambda dtype: img2unicode.BasicGammaOptimizer(use_color, templates=templates, dtype=dtype)
+    assert changed(img2unicode.GammaRenderer, make) <= MAX_CHANGED